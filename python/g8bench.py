@@ -0,0 +1,475 @@
+"""Benchmarks for the g8 command-line tool.
+
+`g8bench.py run` builds a synthetic repository with a local bare origin, times g8 commands end to
+end against it and writes the results as JSON. GitHub calls made by send and land go to a local
+fake server. Pass a previous result file with --baseline to fail on regressions.
+
+`g8bench.py startup` runs local-only commands under python -X importtime and fails if they import
+the GitHub client or exceed an import-time budget.
+"""
+
+import click
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+import gitate
+import gitate_github
+
+GITATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gitate.py')
+
+# Read-only queries issued by g8 commands, answered by the batch backend when enabled.
+QUERIES = [
+    ['rev-parse', '--show-toplevel'],
+    ['symbolic-ref', '--short', 'HEAD'],
+    ['rev-parse', '-q', '--verify', 'HEAD'],
+    ['show', '-s', '--format=%s', 'HEAD'],
+    ['log', '-1', '--pretty=%s'],
+    ['log', '-1', '--pretty=%b'],
+    ['log', '-1', '--pretty=%H'],
+]
+
+# Editor that leaves file lists alone and fills in empty commit messages.
+EDITOR_SCRIPT = """#!/bin/sh
+grep -q '^[^#]' "$1" || echo 'Benchmark change.' >> "$1"
+"""
+
+# Identity for commits the harness and the fake server create in the origin repository.
+IDENTITY = {
+    'GIT_AUTHOR_NAME': 'Bench',
+    'GIT_AUTHOR_EMAIL': 'bench@example.com',
+    'GIT_COMMITTER_NAME': 'Bench',
+    'GIT_COMMITTER_EMAIL': 'bench@example.com',
+}
+
+# Commands that never talk to GitHub, and must start without importing its client.
+LOCAL_COMMANDS = [['status'], ['ls'], ['diff'], ['log'], ['help']]
+
+# Modules that only GitHub commands may import.
+GITHUB_MODULES = {'github', 'gitate_github', 'requests', 'urllib3'}
+
+def git(args, cwd, input=None, env=None):
+    """Run a git command for the harness itself and return its stripped output."""
+    env = dict(os.environ, **IDENTITY, **(env or {}))
+    result = sp.run(['git'] + args, cwd=cwd, input=input, env=env, stdout=sp.PIPE, check=True)
+    return result.stdout.decode('utf-8').strip()
+
+class FakeGithub(object):
+    """Minimal GitHub REST API serving pull requests for the synthetic origin repository."""
+    def __init__(self, originDir: str, mergeableDelay: int=2):
+        self.originDir = originDir
+        # Number of single pull request reads that report mergeability as still being computed.
+        self.mergeableDelay = mergeableDelay
+        self.lock = threading.Lock()
+        self.reset()
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def handle_one(self, verb):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'null')
+                with fake.lock:
+                    fake.requests += 1
+                    status, data = fake.route(verb, self.path, body)
+                payload = json.dumps(data).encode('utf-8')
+                etag = '"%s"' % hashlib.md5(payload).hexdigest()
+                if verb == 'GET' and status == 200 and self.headers.get('If-None-Match') == etag:
+                    status, payload = 304, b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(payload)
+            def do_GET(self):
+                self.handle_one('GET')
+            def do_POST(self):
+                self.handle_one('POST')
+            def do_PUT(self):
+                self.handle_one('PUT')
+            def do_PATCH(self):
+                self.handle_one('PATCH')
+            def do_DELETE(self):
+                self.handle_one('DELETE')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self) -> None:
+        self.pulls = {}
+        self.requests = 0
+
+    def headSha(self, ref: str) -> str:
+        return git(['rev-parse', 'refs/heads/%s' % ref], self.originDir)
+
+    def repoJson(self, fullName: str) -> dict:
+        owner, name = fullName.split('/', 1)
+        return {
+            'id': 1,
+            'name': name,
+            'full_name': fullName,
+            'default_branch': 'master',
+            'owner': {'login': owner},
+            'url': '%s/repos/%s' % (self.url, fullName),
+        }
+
+    def pullJson(self, fullName: str, pull: dict, complete: bool) -> dict:
+        data = {
+            'number': pull['number'],
+            'url': '%s/repos/%s/pulls/%d' % (self.url, fullName, pull['number']),
+            'state': pull['state'],
+            'title': pull['title'],
+            'body': pull['body'],
+            'merged': pull['merged'],
+            'head': {'ref': pull['head'], 'sha': self.headSha(pull['head']), 'label': pull['head']},
+            'base': {'ref': pull['base']},
+            'requested_reviewers': [{'login': x} for x in pull['reviewers']],
+        }
+        if complete:
+            # GitHub computes mergeability in the background after a pull request changes.
+            data['mergeable'] = None if pull['reads'] < self.mergeableDelay else True
+            data['mergeable_state'] = 'unknown' if data['mergeable'] is None else 'clean'
+            pull['reads'] += 1
+        return data
+
+    def graphql(self, variables: dict) -> dict:
+        """Answer g8's pull status query: alias cN looks up the open pull request for branch bN."""
+        fullName = '%s/%s' % (variables['owner'], variables['name'])
+        repository = {}
+        for key, branch in variables.items():
+            if not re.match(r'b\d+$', key):
+                continue
+            pulls = [x for x in self.pulls.values() if x['state'] == 'open' and x['head'] == branch]
+            repository['c' + key[1:]] = {'nodes': [{
+                'number': x['number'],
+                'url': '%s/repos/%s/pulls/%d' % (self.url, fullName, x['number']),
+                'reviewDecision': 'REVIEW_REQUIRED' if x['reviewers'] else None,
+                'mergeable': 'MERGEABLE',
+                'commits': {'nodes': [{'commit': {'statusCheckRollup': None}}]},
+            } for x in pulls[:1]]}
+        return {'data': {'repository': repository}}
+
+    def route(self, verb: str, path: str, body) -> tuple:
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'graphql':
+            return (200, self.graphql(body['variables']))
+        if parts[0] == 'orgs':
+            return (200, {'login': parts[1], 'url': '%s/orgs/%s' % (self.url, parts[1])})
+        if parts[0] != 'repos':
+            return (404, {'message': 'Not Found'})
+        if 'pulls' not in parts:
+            return (200, self.repoJson('/'.join(parts[1:])))
+        index = parts.index('pulls')
+        fullName = '/'.join(parts[1:index])
+        rest = parts[index + 1:]
+        if not rest and verb == 'GET':
+            head = query.get('head', [''])[0].split(':', 1)[-1]
+            pulls = [x for x in self.pulls.values() if x['state'] == 'open' and (not head or x['head'] == head)]
+            return (200, [self.pullJson(fullName, x, False) for x in pulls])
+        if not rest and verb == 'POST':
+            number = len(self.pulls) + 1
+            self.pulls[number] = {
+                'number': number,
+                'state': 'open',
+                'title': body['title'],
+                'body': body.get('body'),
+                'head': body['head'],
+                'base': body['base'],
+                'merged': False,
+                'reviewers': [],
+                'reads': 0,
+            }
+            return (201, self.pullJson(fullName, self.pulls[number], True))
+        pull = self.pulls.get(int(rest[0]))
+        if not pull:
+            return (404, {'message': 'Not Found'})
+        if len(rest) == 1:
+            return (200, self.pullJson(fullName, pull, True))
+        if rest[1] == 'requested_reviewers':
+            pull['reviewers'].extend(body['reviewers'])
+            return (201, self.pullJson(fullName, pull, False))
+        if rest[1] == 'merge':
+            sha = self.headSha(pull['head'])
+            if body.get('sha') and body['sha'] != sha:
+                return (409, {'message': 'Head branch was modified.'})
+            # Squash merge onto the origin master branch.
+            tree = git(['rev-parse', '%s^{tree}' % sha], self.originDir)
+            merged = git(['commit-tree', tree, '-p', 'refs/heads/master', '-m', body.get('commit_title') or pull['title']],
+                    self.originDir)
+            git(['update-ref', 'refs/heads/master', merged], self.originDir)
+            pull['state'] = 'closed'
+            pull['merged'] = True
+            return (200, {'sha': merged, 'merged': True, 'message': 'Pull Request successfully merged'})
+        return (404, {'message': 'Not Found'})
+
+class SyntheticRepo(object):
+    """A generated repository with a bare origin, a clone on change 'bench' and local edits."""
+    def __init__(self, root: str, files: int, depth: int, changes: int, untracked: int):
+        self.root = root
+        self.origin = os.path.join(root, 'origin.git')
+        self.work = os.path.join(root, 'work')
+        self.files = ['src/d%04d/f%05d.txt' % (i // 100, i) for i in range(files)]
+        self.changes = changes
+        self.untracked = untracked
+        self.editor = os.path.join(root, 'editor.sh')
+        with open(self.editor, 'w') as f:
+            f.write(EDITOR_SCRIPT)
+        os.chmod(self.editor, 0o755)
+
+        git(['init', '-q', '--bare', self.origin], root)
+        git(['symbolic-ref', 'HEAD', 'refs/heads/master'], self.origin)
+        git(['fast-import', '--quiet'], self.origin, input=self.history(depth))
+        git(['clone', '-q', 'file://' + self.origin, self.work], root)
+        for key, value in [
+                ('user.name', 'Bench'),
+                ('user.email', 'bench@example.com'),
+                ('credential.helper', '!f() { echo username=bench; echo password=bench; }; f')]:
+            git(['config', key, value], self.work)
+        git(['checkout', '-q', '-b', 'bench'], self.work)
+        with open(os.path.join(self.work, self.files[0]), 'a') as f:
+            f.write('bench\n')
+        git(['commit', '-q', '-a', '-m', 'Benchmark change.'], self.work)
+        self.masterSha = git(['rev-parse', 'master'], self.work)
+        self.benchSha = git(['rev-parse', 'bench'], self.work)
+        self.restore()
+
+    def history(self, depth: int) -> bytes:
+        """fast-import stream with every file in the first commit and small edits after it."""
+        rand = random.Random(0)
+        stream = []
+        for i in range(depth):
+            stream.append('commit refs/heads/master')
+            stream.append('committer Bench <bench@example.com> %d +0000' % (1500000000 + i))
+            message = 'Commit %d.' % i
+            stream.append('data %d\n%s' % (len(message), message))
+            edited = self.files if i == 0 else rand.sample(self.files, min(3, len(self.files)))
+            for path in edited:
+                content = '%s %d\n' % (path, i)
+                stream.append('M 100644 inline %s\ndata %d\n%s' % (path, len(content), content))
+            stream.append('')
+        return '\n'.join(stream).encode('utf-8')
+
+    def restore(self) -> None:
+        """Reset origin and clone to the generated state and recreate local edits."""
+        for ref in git(['for-each-ref', '--format=%(refname)', 'refs/heads'], self.origin).split('\n'):
+            if ref and ref != 'refs/heads/master':
+                git(['update-ref', '-d', ref], self.origin)
+        git(['update-ref', 'refs/heads/master', self.masterSha], self.origin)
+        git(['checkout', '-q', '-f', '-B', 'bench', self.benchSha], self.work)
+        git(['clean', '-q', '-f', '-d'], self.work)
+        git(['update-ref', 'refs/heads/master', self.masterSha], self.work)
+        git(['update-ref', 'refs/remotes/origin/master', self.masterSha], self.work)
+        for ref in git(['for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/remotes/origin'],
+                self.work).split('\n'):
+            if ref not in ('refs/heads/master', 'refs/heads/bench', 'refs/remotes/origin/master',
+                    'refs/remotes/origin/HEAD'):
+                git(['update-ref', '-d', ref], self.work)
+        for path in self.files[1:self.changes + 1]:
+            with open(os.path.join(self.work, path), 'a') as f:
+                f.write('local edit\n')
+        for i in range(self.untracked):
+            path = os.path.join(self.work, 'untracked', 'u%05d.txt' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('untracked\n')
+
+    def advanceOrigin(self) -> None:
+        """Land an unrelated commit on origin master."""
+        content = 'upstream %f\n' % time.time()
+        blob = git(['hash-object', '-w', '--stdin'], self.origin, input=content.encode('utf-8'))
+        env = {'GIT_INDEX_FILE': os.path.join(self.root, 'upstream.index')}
+        git(['read-tree', 'master'], self.origin, env=env)
+        git(['update-index', '--add', '--cacheinfo', '100644,%s,upstream.txt' % blob], self.origin, env=env)
+        tree = git(['write-tree'], self.origin, env=env)
+        commit = git(['commit-tree', tree, '-p', 'master', '-m', 'Upstream change.'], self.origin)
+        git(['update-ref', 'refs/heads/master', commit], self.origin)
+
+def g8(repo: SyntheticRepo, fake: FakeGithub, args, input: bytes=b'') -> dict:
+    """Run g8 end to end and return wall time and call counts from its profile trace."""
+    trace = os.path.join(repo.root, 'trace.json')
+    env = dict(os.environ, EDITOR=repo.editor, GIT_EDITOR=repo.editor, PAGER='cat', GIT_PAGER='cat')
+    env[gitate_github.GITHUB_API_ENV] = fake.url
+    start = time.perf_counter()
+    result = sp.run([sys.executable, GITATE, '--profile-trace', trace] + args, cwd=repo.work,
+            env=env, input=input, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    wall = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise click.ClickException('g8 %s failed: %s' % (' '.join(args), result.stderr.decode('utf-8')))
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    return {
+        'wall_ms': wall,
+        'git_calls': len([x for x in events if x['cat'] == 'git']),
+        'github_requests': len([x for x in events if x['cat'] == 'github']),
+    }
+
+def importTimes(repo: SyntheticRepo, args) -> tuple:
+    """Run g8 under python -X importtime and return (total import ms, imported module names)."""
+    env = dict(os.environ, PAGER='cat', GIT_PAGER='cat')
+    result = sp.run([sys.executable, '-X', 'importtime', GITATE] + args, cwd=repo.work, env=env,
+            stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if result.returncode != 0:
+        raise click.ClickException('g8 %s failed: %s' % (' '.join(args), result.stderr.decode('utf-8')))
+    total = 0
+    modules = set()
+    for line in result.stderr.decode('utf-8').splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        # Top-level imports, whose cumulative times include everything they imported.
+        if len(match.group(3)) == 1:
+            total += int(match.group(2))
+    return (total / 1000, modules)
+
+def scenarios(repo: SyntheticRepo, fake: FakeGithub) -> list:
+    """(name, setup, g8 arguments, stdin) for each benchmarked command."""
+    def send():
+        g8(repo, fake, ['send'])
+    return [
+        ('status', None, ['status'], b''),
+        ('ls', None, ['ls'], b''),
+        ('ls-remote', None, ['ls', '--remote'], b''),
+        ('diff', None, ['diff'], b''),
+        ('change', None, ['change', 'master'], b''),
+        ('new', None, ['new'], b''),
+        ('sync', repo.advanceOrigin, ['sync'], b''),
+        ('sync-all', repo.advanceOrigin, ['sync', '--all'], b''),
+        ('revert', None, ['revert'] + repo.files[1:min(repo.changes, 10) + 1], b''),
+        ('send', None, ['send'], b''),
+        ('land', send, ['land'], b'y\n'),
+    ]
+
+@click.group()
+def cli():
+    """Benchmarks for g8."""
+    pass
+
+@cli.command()
+@click.option('--repeat', default=20, help='Number of times to issue each query')
+def queries(repeat):
+    """Compare forks and wall time of read-only queries with and without the batch backend."""
+    answers = {}
+    click.echo('%-8s %8s %8s %10s %12s' % ('backend', 'calls', 'forks', 'total ms', 'ms per call'))
+    for batch in (False, True):
+        # Without memoization every call reaches the backend being measured.
+        git = gitate.GitWrapper(verbose=False, batch=batch, memoize=False)
+        start = time.perf_counter()
+        results = []
+        for i in range(repeat):
+            for query in QUERIES:
+                results.append(git.callAndGetUtf8(list(query)))
+        elapsed = (time.perf_counter() - start) * 1000
+        git.close()
+        answers[batch] = results
+        calls = repeat * len(QUERIES)
+        click.echo('%-8s %8d %8d %10.1f %12.2f' % (
+            'batch' if batch else 'popen', calls, git.spawnCount, elapsed, elapsed / calls))
+    if answers[False] != answers[True]:
+        raise click.ClickException('batch answers differ from git')
+
+@cli.command()
+@click.option('--budget', default=150.0, help='Allowed import time in ms for each local command')
+@click.option('--repeat', default=5, help='Runs per command, the median is reported')
+def startup(budget, repeat):
+    """Check that local commands import quickly and never load the GitHub client."""
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='g8bench') as root:
+        repo = SyntheticRepo(root, 50, 5, 2, 2)
+        for args in LOCAL_COMMANDS:
+            runs = [importTimes(repo, args) for i in range(repeat)]
+            total = statistics.median([x[0] for x in runs])
+            loaded = sorted(set.union(*[x[1] for x in runs]) & GITHUB_MODULES)
+            name = ' '.join(args)
+            click.echo('%-8s %8.1f ms imports%s' % (name, total,
+                ', loads %s' % ', '.join(loaded) if loaded else ''))
+            if loaded:
+                failures.append('%s imports %s' % (name, ', '.join(loaded)))
+            if total > budget:
+                failures.append('%s takes %.1f ms to import, over %.1f ms' % (name, total, budget))
+    if failures:
+        raise click.ClickException('; '.join(failures))
+
+@cli.command()
+@click.option('--files', default=1000, help='Number of tracked files')
+@click.option('--depth', default=50, help='Number of commits on master')
+@click.option('--changes', default=20, help='Number of locally modified files')
+@click.option('--untracked', default=20, help='Number of untracked files')
+@click.option('--repeat', default=5, help='Runs per command, the median is reported')
+@click.option('--only', multiple=True, help='Only run the named commands')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results as JSON to this file')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare against results in this file')
+@click.option('--tolerance', default=.2, help='Allowed fractional slowdown against the baseline')
+def run(files, depth, changes, untracked, repeat, only, output, baseline, tolerance):
+    """Time g8 commands end to end against a synthetic repository."""
+    with tempfile.TemporaryDirectory(prefix='g8bench') as root:
+        repo = SyntheticRepo(root, files, depth, changes, untracked)
+        fake = FakeGithub(repo.origin)
+        results = {}
+        for name, setup, args, input in scenarios(repo, fake):
+            if only and name not in only:
+                continue
+            runs = []
+            for i in range(repeat):
+                repo.restore()
+                fake.reset()
+                if setup:
+                    setup()
+                runs.append(g8(repo, fake, args, input))
+            results[name] = {
+                'wall_ms': statistics.median([x['wall_ms'] for x in runs]),
+                'git_calls': max([x['git_calls'] for x in runs]),
+                'github_requests': max([x['github_requests'] for x in runs]),
+                'runs': [x['wall_ms'] for x in runs],
+            }
+            click.echo('%-8s %10.1f ms %5d git calls %5d github requests' % (name,
+                results[name]['wall_ms'], results[name]['git_calls'], results[name]['github_requests']))
+        fake.server.shutdown()
+
+    report = {
+        'config': {'files': files, 'depth': depth, 'changes': changes, 'untracked': untracked,
+            'repeat': repeat},
+        'git': git(['--version'], '.'),
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if baseline:
+        with open(baseline) as f:
+            expected = json.load(f)
+        if expected.get('config') != report['config']:
+            click.echo('Warning: baseline was recorded with %s' % expected.get('config'))
+        regressions = []
+        for name, result in sorted(results.items()):
+            old = expected['results'].get(name)
+            if not old:
+                continue
+            ratio = result['wall_ms'] / old['wall_ms']
+            click.echo('%-8s %+7.1f%% time, %+d git calls, %+d github requests' % (name,
+                (ratio - 1) * 100, result['git_calls'] - old['git_calls'],
+                result['github_requests'] - old['github_requests']))
+            if (ratio > 1 + tolerance or result['git_calls'] > old['git_calls'] or
+                    result['github_requests'] > old['github_requests']):
+                regressions.append(name)
+        if regressions:
+            raise click.ClickException('Regressed against baseline: %s' % ', '.join(regressions))
+
+if __name__ == '__main__':
+    cli(prog_name='g8bench')
@@ -0,0 +1,164 @@
+"""Thin client that runs quick g8 commands in a warm daemon.
+
+Alias g8 to this script to use it. Commands in DAEMON_COMMANDS are sent to g8daemon.py over a
+per-user Unix socket, together with argv, the working directory, the environment and the terminal
+file descriptors; the daemon forks a child that already has click, PyGithub and gitate imported.
+The daemon is started on first use, exits when idle, and is replaced when gitate.py changes.
+Other commands, which prompt, open editors or wait on the network, run gitate.py directly, as
+does everything on platforms where the client cannot check who runs the daemon.
+
+This module only imports the standard library modules it needs, so starting it stays cheap.
+"""
+
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GITATE = os.path.join(HERE, 'gitate.py')
+DAEMON = os.path.join(HERE, 'g8daemon.py')
+
+# Quick read-only commands worth sending to the daemon.
+DAEMON_COMMANDS = {'status', 'ls', 'diff', 'log', 'help'}
+
+# Seconds to wait for a newly started daemon to listen.
+DAEMON_START_TIMEOUT = 5
+
+# How to ask the kernel for the credentials of a Unix socket peer: the getsockopt level and
+# option, the struct the answer is read with, and the index of the uid in it. Without a way to
+# tell who is at the other end the daemon is never used.
+if hasattr(socket, 'SO_PEERCRED'):
+    # Linux: struct ucred {pid, uid, gid}.
+    PEER_CREDENTIALS = (socket.SOL_SOCKET, socket.SO_PEERCRED, '3i', 1)
+elif sys.platform == 'darwin' or sys.platform.startswith('freebsd'):
+    # macOS and FreeBSD: struct xucred {cr_version, cr_uid, cr_ngroups, cr_groups[16]} at SOL_LOCAL.
+    PEER_CREDENTIALS = (0, getattr(socket, 'LOCAL_PEERCRED', 1), 'IIh2x16I', 1)
+else:
+    PEER_CREDENTIALS = None
+
+def privateDir(path: str) -> bool:
+    """Create path as a directory only this user can use, or check that it already is one.
+
+    A symlink, or a directory that belongs to someone else, is refused, as whoever controls it
+    could listen in place of the daemon. Our own directory is narrowed to 0700 if it is open to
+    others, since only we can have written to it.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        return False
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return True
+
+def socketPath():
+    """Per-user socket of the daemon, in XDG_RUNTIME_DIR when it is set.
+
+    Returns None if its directory cannot be made private to this user.
+    """
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtimeDir:
+        runtimeDir = '/tmp/g8-%d' % os.getuid()
+        if not privateDir(runtimeDir):
+            return None
+    socketDir = os.path.join(runtimeDir, 'g8')
+    if not privateDir(socketDir):
+        return None
+    return os.path.join(socketDir, 'daemon.sock')
+
+def peerUid(sock: socket.socket):
+    """The uid of the process at the other end of a Unix socket, or None if it cannot be told."""
+    if PEER_CREDENTIALS is None:
+        return None
+    level, option, layout, index = PEER_CREDENTIALS
+    try:
+        creds = sock.getsockopt(level, option, struct.calcsize(layout))
+        return struct.unpack(layout, creds)[index]
+    except (OSError, struct.error):
+        return None
+
+def runDirectly(argv: list) -> None:
+    os.execv(sys.executable, [sys.executable, GITATE] + argv)
+
+def commandName(argv: list):
+    """The g8 subcommand in argv, skipping global options."""
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+def connect():
+    """Connect to the daemon, starting it if needed.
+
+    Returns None if it cannot be reached, or if whatever listens is not run by this user.
+    """
+    path = socketPath()
+    if path is None:
+        return None
+    started = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+        else:
+            # The request carries the environment and the terminal, so only hand it to ourselves.
+            if peerUid(sock) != os.getuid():
+                sock.close()
+                return None
+            return sock
+        if started is None:
+            started = time.time()
+            subprocess.Popen([sys.executable, DAEMON], start_new_session=True, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elif time.time() - started > DAEMON_START_TIMEOUT:
+            return None
+        time.sleep(.01)
+
+def run(argv: list) -> int:
+    """Run g8 with argv in the daemon and return its exit code."""
+    for attempt in range(2):
+        sock = connect()
+        if sock is None:
+            runDirectly(argv)
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}) + '\n'
+        socket.send_fds(sock, [request.encode('utf-8')], [0, 1, 2])
+        replies = sock.makefile('r')
+        pid = None
+        for line in replies:
+            reply = json.loads(line)
+            if 'restart' in reply:
+                # The daemon is running older code and has shut down; start a new one.
+                break
+            if 'pid' in reply:
+                pid = reply['pid']
+                # The command runs in its own process group; pass on signals from the terminal.
+                def forward(signum, frame):
+                    os.killpg(pid, signum)
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+                    signal.signal(signum, forward)
+            if 'exit' in reply:
+                return reply['exit']
+        else:
+            # The daemon went away without an exit code.
+            return 1 if pid else runDirectly(argv)
+        sock.close()
+    runDirectly(argv)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if commandName(args) not in DAEMON_COMMANDS or PEER_CREDENTIALS is None:
+        runDirectly(args)
+    sys.exit(run(args))
@@ -0,0 +1,147 @@
+"""Warm per-user daemon that runs g8 commands for g8client.py.
+
+The daemon imports gitate once, with click and PyGithub, and loads the word index. Each request
+carries argv, the working directory, the environment and the client's stdin, stdout and stderr
+as file descriptors. A forked child takes them over and runs the command, so commands never share
+cwd, environment or git state, and a slow command never blocks the next one. The child reports
+its pid, so the client can forward signals, and then its exit code.
+
+The daemon exits after IDLE_TIMEOUT seconds without requests. When gitate.py, gitate_github.py or
+this file change it tells the client to restart and exits, so edits take effect on the next command.
+"""
+
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+import traceback
+import g8client
+import gitate
+import gitate_github
+
+# Seconds without requests after which the daemon exits.
+IDLE_TIMEOUT = 30 * 60
+
+# Longest request line accepted from a client, in bytes.
+MAX_REQUEST_SIZE = 1 << 20
+
+# Source files whose modification means the daemon is running stale code.
+SOURCES = [gitate.__file__, gitate_github.__file__, __file__, g8client.__file__]
+
+def sourceTimes() -> list:
+    return [os.stat(path).st_mtime for path in SOURCES]
+
+def readRequest(conn: socket.socket) -> tuple:
+    """Read the request line and the three file descriptors sent with it."""
+    data, fds, flags, addr = socket.recv_fds(conn, MAX_REQUEST_SIZE, 3)
+    while data and not data.endswith(b'\n'):
+        chunk = conn.recv(MAX_REQUEST_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return (json.loads(data), fds)
+
+def reply(conn: socket.socket, message: dict) -> None:
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+def runCommand(conn: socket.socket, request: dict, fds: list) -> None:
+    """In a forked child, take over the client's terminal and run the command. Never returns."""
+    code = 1
+    try:
+        os.setpgid(0, 0)
+        reply(conn, {'pid': os.getpid()})
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        try:
+            gitate.cli(args=request['argv'], prog_name='g8')
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            reply(conn, {'exit': code})
+        finally:
+            os._exit(code)
+
+def serve() -> None:
+    path = g8client.socketPath()
+    if path is None or g8client.PEER_CREDENTIALS is None:
+        # The socket directory is not private to this user, or clients could not be told apart;
+        # clients run commands directly.
+        return
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except OSError:
+        # Another daemon may already be listening; otherwise the socket is left over.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return
+        except OSError:
+            os.remove(path)
+            server.bind(path)
+        finally:
+            probe.close()
+    server.listen()
+
+    # Warm what every command would otherwise load on its own.
+    try:
+        gitate.WordIndex.load()
+    except OSError:
+        pass
+    started = sourceTimes()
+    children = set()
+    lastRequest = time.time()
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    try:
+        while True:
+            # Reap finished commands.
+            for pid in list(children):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    children.discard(pid)
+            if not children and time.time() - lastRequest > IDLE_TIMEOUT:
+                return
+            if not selector.select(timeout=1):
+                continue
+            conn, addr = server.accept()
+            lastRequest = time.time()
+            if g8client.peerUid(conn) != os.getuid():
+                conn.close()
+                continue
+            request, fds = readRequest(conn)
+            if sourceTimes() != started:
+                os.remove(path)
+                reply(conn, {'restart': True})
+                conn.close()
+                for fd in fds:
+                    os.close(fd)
+                return
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                runCommand(conn, request, fds)
+            children.add(pid)
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+    finally:
+        if os.path.exists(path) and started == sourceTimes():
+            os.remove(path)
+
+if __name__ == '__main__':
+    serve()
@@ -2,6 +2,9 @@
 
 import click
 import getpass
+import json
+import math
+import mmap
 import subprocess as sp
 import os
 import re
@@ -9,37 +12,204 @@ import tempfile
 import random
 import shlex
 import string
+import struct
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import update_wrapper
-from itertools import groupby
 from typing import Callable
 from typing import Optional
 from typing import Union
 from typing import List
 from typing import BinaryIO
-import github
-from github import Github
-from github import Organization
-from github import Repository
-from github import PullRequest
-from urllib.parse import urlparse
-
+from typing import Iterator
+
+COMMIT_TEMPLATE = (
+    '\n'
+    '{0} Please enter the commit message for your changes. Lines starting\n'
+    "{0} with '{0}' will be ignored, and an empty message aborts the commit.\n")
+# Comment characters core.commentChar=auto picks from, in git's order.
+AUTO_COMMENT_CHARS = '#;@!$%^&|:'
 STAGED_MESSAGE = 'Stash staged files.'
 UNTRACKED_MESSAGE = 'Stash untracked files.'
-
-def randomWord(length):
-    wordFile = open('/usr/share/dict/words')
-    fileLength = os.stat('/usr/share/dict/words').st_size
-    bufferLength = 2048
-    result = ''
-    while not result:
-        offset = random.randint(0, fileLength // bufferLength) * bufferLength
-        wordFile.seek(offset)
-        segment = wordFile.read(bufferLength)
-        words = [x for x in segment.split('\n')[1:-1] if len(x) == length and not x[0].istitle()]
-        if words:
-            result = words[random.randint(0, len(words) - 1)]
-    return result
+# Default seconds land waits for GitHub to finish its merge check.
+PULL_POLL_TIMEOUT = 300
+
+# Bytes read from a streamed git command at a time.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Paths passed to one ls-tree call, which has no way to read them from stdin.
+LS_TREE_PATHS = 1000
+
+# Lines written to the terminal at a time when echoing streamed output.
+ECHO_BATCH_SIZE = 256
+
+# Number of fork points remembered across invocations.
+FORK_POINT_CACHE_SIZE = 64
+
+# Index entries above which g8 offers the settings in PERF_SETTINGS.
+LARGE_REPO_FILES = 50000
+
+# Git settings that speed up the status scans of large repositories, as (key, value).
+PERF_SETTINGS = [
+    ('feature.manyFiles', 'true'),
+    ('index.version', '4'),
+    ('core.untrackedCache', 'true'),
+    # The builtin daemon only exists in git builds with fsmonitor support.
+    ('core.fsmonitor', 'true'),
+]
+
+# Commands that scan the working tree, and so prompt for PERF_SETTINGS in large repositories.
+SCANNING_COMMANDS = {'status', 'change', 'new', 'sync', 'send', 'land'}
+
+# Timed runs of each scan in `g8 doctor --perf`, after one warm-up run.
+PERF_SAMPLES = 3
+
+# Worktrees kept for changes when `git config g8.worktrees` is on, unless g8.worktreePool is set.
+WORKTREE_POOL_DEFAULT = 4
+
+# Changes replayed at once by sync --all.
+SYNC_WORKERS = os.cpu_count() or 4
+
+# Repository state each read-only subcommand depends on. Their output is memoized per invocation.
+QUERY_DEPENDENCIES = {
+    'rev-parse': {'refs'},
+    'symbolic-ref': {'refs'},
+    'show': {'refs'},
+    'log': {'refs'},
+    'merge-base': {'refs'},
+    'for-each-ref': {'refs'},
+    'show-ref': {'refs'},
+    'ls-tree': {'refs'},
+    'cat-file': {'refs'},
+    'diff': {'refs', 'index', 'worktree'},
+    'ls-files': {'index', 'worktree'},
+    'status': {'refs', 'index', 'worktree'},
+    'remote': {'config'},
+    'config': {'config'},
+    'worktree': {'refs'},
+}
+ALL_STATE = {'refs', 'index', 'worktree', 'config'}
+
+# Repository state changed by mutating subcommands. Unlisted subcommands invalidate everything.
+COMMAND_EFFECTS = {
+    'add': {'index'},
+    'rm': {'index', 'worktree'},
+    'mv': {'index', 'worktree'},
+    'commit': {'refs', 'index'},
+    'reset': {'refs', 'index', 'worktree'},
+    'push': {'refs'},
+    'fetch': {'refs'},
+    'branch': {'refs', 'config'},
+    'update-ref': {'refs'},
+    'read-tree': {'index', 'worktree'},
+    'update-index': {'index'},
+    'checkout-index': {'worktree'},
+    'config': {'config'},
+    'write-tree': set(),
+    'commit-tree': set(),
+    'merge-tree': set(),
+    'diff-tree': set(),
+    'patch-id': set(),
+    'var': set(),
+    'hash-object': set(),
+    'credential': set(),
+    'ls-remote': set(),
+}
+
+WORDS_FILE = '/usr/share/dict/words'
+WORD_INDEX_MAGIC = b'G8W1'
+# Magic, dictionary mtime and size, then the number of buckets.
+WORD_INDEX_HEADER = struct.Struct('<4sqqI')
+# Word length, word count and offset of each bucket of fixed-width words.
+WORD_INDEX_BUCKET = struct.Struct('<III')
+
+class WordIndex(object):
+    """Memory-mapped lowercase dictionary words bucketed by length, rebuilt when the dictionary changes."""
+    _loaded = None
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.mtime, self.size, bucketCount = WORD_INDEX_HEADER.unpack_from(self.data)
+        if magic != WORD_INDEX_MAGIC:
+            raise ValueError('Not a word index: %s' % path)
+        self.buckets = {}
+        for i in range(bucketCount):
+            length, count, offset = WORD_INDEX_BUCKET.unpack_from(
+                    self.data, WORD_INDEX_HEADER.size + i * WORD_INDEX_BUCKET.size)
+            self.buckets[length] = (count, offset)
+
+    @staticmethod
+    def path() -> str:
+        cacheHome = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        return os.path.join(cacheHome, 'g8', 'words.idx')
+
+    @staticmethod
+    def build(path: str) -> None:
+        """Write the index for the current dictionary, atomically replacing any old one."""
+        stat = os.stat(WORDS_FILE)
+        buckets = {}
+        with open(WORDS_FILE, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                word = line.strip()
+                # Only words that make plain branch names; this also skips proper nouns.
+                if re.fullmatch('[a-z]+', word):
+                    buckets.setdefault(len(word), set()).add(word)
+
+        offset = WORD_INDEX_HEADER.size + len(buckets) * WORD_INDEX_BUCKET.size
+        header = [WORD_INDEX_HEADER.pack(WORD_INDEX_MAGIC, stat.st_mtime_ns, stat.st_size, len(buckets))]
+        body = []
+        for length, words in sorted(buckets.items()):
+            header.append(WORD_INDEX_BUCKET.pack(length, len(words), offset))
+            body.append(''.join(sorted(words)).encode('ascii'))
+            offset += length * len(words)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(header + body))
+        os.replace(tempPath, path)
+
+    @classmethod
+    def load(cls) -> 'WordIndex':
+        """Return the process-wide index, building it on first use or when the dictionary changed."""
+        if cls._loaded is None:
+            path = cls.path()
+            stat = os.stat(WORDS_FILE)
+            try:
+                index = cls(path)
+            except (OSError, ValueError, struct.error):
+                index = None
+            if not index or (index.mtime, index.size) != (stat.st_mtime_ns, stat.st_size):
+                cls.build(path)
+                index = cls(path)
+            cls._loaded = index
+        return cls._loaded
+
+    def count(self, length: int) -> int:
+        return self.buckets.get(length, (0, 0))[0]
+
+    def word(self, length: int, i: int) -> str:
+        offset = self.buckets[length][1] + i * length
+        return self.data[offset:offset + length].decode('ascii')
+
+def randomWord(length: int, taken=frozenset()) -> str:
+    """Pick a random dictionary word of the given length that is not in taken."""
+    index = WordIndex.load()
+    count = index.count(length)
+    if not count:
+        raise click.ClickException('No %d letter words in %s' % (length, WORDS_FILE))
+    # Visit the bucket in a random coprime stride so each word is considered at most once.
+    start = random.randrange(count)
+    stride = random.randrange(1, count) if count > 1 else 1
+    while math.gcd(stride, count) != 1:
+        stride -= 1
+    for i in range(count):
+        word = index.word(length, (start + i * stride) % count)
+        if word not in taken:
+            return word
+    raise click.ClickException('Every %d letter word is already a change' % length)
 
 class NamedVar(object):
     def __init__(self, name: str, value: str, shellDesc: str):
@@ -94,13 +264,352 @@ def rootRunnable(callFnIn):
         return callFnIn(*args, **kwargs)
     return callFnOut
 
+def gitSubcommand(argValues: List[str]) -> tuple:
+    """Split git arguments into the subcommand and its arguments, skipping global options."""
+    i = 0
+    while i < len(argValues) and argValues[i].startswith('-'):
+        i += 2 if argValues[i] in ('-C', '-c') else 1
+    return (argValues[i] if i < len(argValues) else None, argValues[i + 1:])
+
+def isReadOnly(argValues: List[str]) -> bool:
+    """Return True if a git command only reads repository state."""
+    command, rest = gitSubcommand(argValues)
+    if command == 'remote':
+        return rest[:1] == ['get-url']
+    if command == 'worktree':
+        return rest[:1] == ['list']
+    if command == 'config':
+        return any(x in ('--get', '--get-all', '--get-regexp', '-l', '--list') for x in rest)
+    if command == 'symbolic-ref':
+        return len([x for x in rest if not x.startswith('-')]) == 1
+    return command in QUERY_DEPENDENCIES
+
+def formatCommit(sha: str, raw: bytes, fmt: str) -> Optional[str]:
+    """Expand a single-placeholder pretty format for a raw commit object, or None if unsupported."""
+    header, _, message = raw.partition(b'\n\n')
+    if any(line.startswith(b'encoding ') for line in header.split(b'\n')):
+        # Leave re-encoding to git.
+        return None
+    if fmt == '%H':
+        return sha
+    if fmt == '%T':
+        return header.split(b'\n', 1)[0].split(b' ', 1)[1].decode('utf-8')
+    lines = message.decode('utf-8').split('\n')
+    # Skip leading blank lines, take the first paragraph as the subject and the rest as the body.
+    start = 0
+    while start < len(lines) and not lines[start].strip():
+        start += 1
+    end = start
+    while end < len(lines) and lines[end].strip():
+        end += 1
+    if fmt == '%s':
+        return ' '.join([x.rstrip() for x in lines[start:end]])
+    if fmt == '%b':
+        while end < len(lines) and not lines[end].strip():
+            end += 1
+        return '\n'.join(lines[end:])
+    return None
+
+class GitBatch(object):
+    """Long-lived `git cat-file --batch` or `--batch-check` process answering object queries over a pipe."""
+    def __init__(self, mode: str, cwd: str):
+        self.process = sp.Popen(['git', 'cat-file', mode], shell=False, cwd=cwd,
+                stdin=sp.PIPE, stdout=sp.PIPE)
+        self.lock = threading.Lock()
+
+    def query(self, rev: str) -> Optional[tuple]:
+        """Return (sha, type, size, content) for a revision, or None if it does not name an object."""
+        if '\n' in rev or ':' in rev:
+            # Path lookups like HEAD:./file depend on the working directory; leave them to git.
+            return None
+        with self.lock:
+            self.process.stdin.write(rev.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                raise click.ClickException("git cat-file exited unexpectedly")
+            fields = header.decode('utf-8').rstrip('\n').split(' ')
+            if len(fields) != 3 or fields[-1] in ('missing', 'ambiguous'):
+                return None
+            sha, objectType, size = fields[0], fields[1], int(fields[2])
+            content = None
+            if self.process.args[-1] == '--batch':
+                content = self.process.stdout.read(size)
+                self.process.stdout.read(1)
+            return (sha, objectType, size, content)
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, int(-(-fraction * len(ordered) // 1)) - 1)]
+
+class Profiler(object):
+    """Records wall time, exit status and bytes read of git calls and GitHub requests."""
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+
+    def record(self, category: str, name: str, start: float, exitCode: Optional[int], bytesRead: int) -> None:
+        """Record an event that started at perf_counter time start and ends now."""
+        ctx = click.get_current_context(silent=True)
+        self.events.append({
+            'category': category,
+            'name': name,
+            'command': ctx.info_name if ctx else None,
+            'thread': threading.get_ident(),
+            'start': start - self.origin,
+            'duration': time.perf_counter() - start,
+            'exitCode': exitCode,
+            'bytesRead': bytesRead,
+        })
+
+    def summary(self) -> str:
+        """Format count, total, p50 and p95 per subcommand."""
+        durations = {}
+        for event in self.events:
+            durations.setdefault(event['name'], []).append(event['duration'] * 1000)
+        lines = ['%-40s %6s %10s %8s %8s' % ('call', 'count', 'total ms', 'p50 ms', 'p95 ms')]
+        for name, values in sorted(durations.items(), key=lambda x: -sum(x[1])):
+            lines.append('%-40s %6d %10.1f %8.1f %8.1f' % (name, len(values), sum(values),
+                percentile(values, .5), percentile(values, .95)))
+        lines.append('%-40s %6s %10.1f' % ('wall', '',
+            (time.perf_counter() - self.origin) * 1000))
+        return '\n'.join(lines)
+
+    def writeTrace(self, path: str) -> None:
+        """Write events in Chrome trace event format."""
+        traceEvents = [{
+            'name': event['name'],
+            'cat': event['category'],
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['duration'] * 1e6,
+            'pid': os.getpid(),
+            'tid': event['thread'],
+            'args': {
+                'command': event['command'],
+                'exitCode': event['exitCode'],
+                'bytesRead': event['bytesRead'],
+            },
+        } for event in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': traceEvents}, f)
+
 class GitWrapper(object):
-    def __init__(self, verbose: bool):
+    def __init__(self, verbose: bool, batch: bool=True, useCache: bool=True, memoize: bool=True):
         self.verbose = verbose
+        # Answer read-only queries from long-lived cat-file processes instead of forking git.
+        self.batch = batch
+        # Allow results persisted under .git/g8 to be reused.
+        self.useCache = useCache
+        # Reuse the output of read-only commands until a write invalidates it.
+        self.memoize = memoize
+        self.cacheStats = {}
+        self.spawnCount = 0
+        # Optional Profiler recording every git process and batch query.
+        self.profiler = None
+        self._repos = {}
+        self._batches = {}
+        # Memoized output of read-only commands, keyed by (kind, cwd, argv).
+        self._queries = {}
+        self._generation = 0
+        self._lock = threading.RLock()
+
+    def _run(self, argValues: List[str], input: Optional[bytes]=None, **kwargs) -> tuple:
+        """Fork a git process, wait for it, and return (returncode, stdout)."""
+        start = time.perf_counter()
+        p = sp.Popen(['git'] + argValues, shell=False, **kwargs)
+        self.spawnCount += 1
+        try:
+            if kwargs.get('stdout') == sp.PIPE or kwargs.get('stdin') == sp.PIPE:
+                output, err = p.communicate(input=input)
+            else:
+                output = None
+                p.wait()
+        finally:
+            self.invalidate(argValues)
+            if self.profiler:
+                self.profiler.record('git', 'git %s' % gitSubcommand(argValues)[0], start,
+                        p.returncode, len(output or b''))
+        return (p.returncode, output)
+
+    def _queryKey(self, kind: str, argValues: List[str]) -> Optional[tuple]:
+        if not self.memoize or not isReadOnly(argValues):
+            return None
+        return (kind, os.getcwd(), tuple(argValues))
+
+    def _recall(self, key: Optional[tuple]) -> tuple:
+        """Return the memoized value or None, and the generation to pass to _remember."""
+        with self._lock:
+            entry = self._queries.get(key) if key else None
+            return (entry and entry[1], self._generation)
+
+    def _remember(self, key: Optional[tuple], argValues: List[str], value, generation: int) -> None:
+        with self._lock:
+            # Drop results that may predate a write made while the query ran on another thread.
+            if key and generation == self._generation:
+                self._queries[key] = (QUERY_DEPENDENCIES[gitSubcommand(argValues)[0]], value)
+
+    def invalidate(self, argValues: List[str]) -> None:
+        """Forget memoized queries that depend on state changed by a git command."""
+        if isReadOnly(argValues):
+            return
+        effects = COMMAND_EFFECTS.get(gitSubcommand(argValues)[0], ALL_STATE)
+        if effects:
+            with self._lock:
+                self._generation += 1
+                self._queries = dict([(key, entry) for key, entry in self._queries.items()
+                    if not (entry[0] & effects)])
+
+    def repoInfo(self) -> Optional[dict]:
+        """Discover toplevel, git dir and common dir of the repository in the working directory."""
+        cwd = os.getcwd()
+        if cwd not in self._repos:
+            returncode, output = self._run(
+                    ['rev-parse', '--show-toplevel', '--absolute-git-dir', '--git-common-dir'],
+                    stdout=sp.PIPE, stderr=sp.DEVNULL)
+            info = None
+            if returncode == 0:
+                topLevel, gitDir, commonDir = output.decode('utf-8').rstrip('\n').split('\n')
+                info = {
+                    'topLevel': topLevel,
+                    'gitDir': gitDir,
+                    'commonDir': os.path.normpath(os.path.join(cwd, commonDir)),
+                }
+            self._repos[cwd] = info
+        return self._repos[cwd]
+
+    def _batch(self, mode: str) -> Optional[GitBatch]:
+        info = self.repoInfo()
+        if not info:
+            return None
+        key = (mode, info['gitDir'])
+        with self._lock:
+            if key not in self._batches:
+                self._batches[key] = GitBatch(mode, info['topLevel'])
+                self.spawnCount += 1
+            return self._batches[key]
+
+    def objectInfo(self, rev: str) -> Optional[tuple]:
+        """Return (sha, type, size) of a revision using the persistent batch-check process."""
+        start = time.perf_counter()
+        batch = self._batch('--batch-check')
+        result = batch and batch.query(rev)
+        if batch and self.profiler:
+            self.profiler.record('git', 'git cat-file --batch-check', start, 0, result and 1 or 0)
+        return result and result[:3]
+
+    def readObject(self, rev: str) -> Optional[tuple]:
+        """Return (sha, type, content) of a revision using the persistent batch process."""
+        start = time.perf_counter()
+        batch = self._batch('--batch')
+        result = batch and batch.query(rev)
+        if batch and self.profiler:
+            self.profiler.record('git', 'git cat-file --batch', start, 0, result and result[2] or 0)
+        return result and (result[0], result[1], result[3])
+
+    def countCache(self, name: str, hit: bool) -> None:
+        """Record a hit or miss of a persistent cache."""
+        stats = self.cacheStats.setdefault(name, [0, 0])
+        stats[0 if hit else 1] += 1
+
+    def cacheDir(self) -> Optional[str]:
+        """Return the directory g8 keeps its caches in, under the common git dir."""
+        info = self.repoInfo()
+        if not info:
+            return None
+        path = os.path.join(info['commonDir'], 'g8')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def readCache(self, name: str) -> dict:
+        """Load a JSON cache file, treating a missing or corrupt file as empty."""
+        path = self.cacheDir()
+        if not self.useCache or not path:
+            return {}
+        try:
+            with open(os.path.join(path, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def writeCache(self, name: str, data: dict) -> None:
+        """Atomically replace a JSON cache file."""
+        path = self.cacheDir()
+        if not self.useCache or not path:
+            return
+        fd, tempPath = tempfile.mkstemp(dir=path, prefix=name)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tempPath, os.path.join(path, name))
+
+    def reportCacheStats(self) -> None:
+        if self.verbose:
+            for name, (hits, misses) in sorted(self.cacheStats.items()):
+                click.echo('(%s cache: %d hits, %d misses)' % (name, hits, misses))
+
+    def close(self) -> None:
+        """Shut down persistent git processes."""
+        for batch in self._batches.values():
+            batch.close()
+        self._batches = {}
+
+    def _query(self, argValues: List[str]) -> str:
+        """Return the UTF-8 output of a command without stdin, memoizing read-only commands."""
+        key = self._queryKey('utf8', argValues)
+        output, generation = self._recall(key)
+        if output is None:
+            output = self._answerFromBatch(argValues)
+        if output is None:
+            returncode, stdout = self._run(argValues, stdout=sp.PIPE)
+            if returncode != 0:
+                command = 'git ' + ' '.join(argValues)
+                raise click.ClickException("%s failed with error %d" % (command, returncode))
+            output = stdout.decode('utf-8')
+        output = output.rstrip()
+        self._remember(key, argValues, output, generation)
+        return output
+
+    def _answerFromBatch(self, argValues: List[str]) -> Optional[str]:
+        """Answer a read-only query without forking git, or None to fall back to a subprocess."""
+        if not self.batch or not argValues:
+            return None
+        command, rest = argValues[0], argValues[1:]
+        if command == 'rev-parse':
+            if rest == ['--show-toplevel']:
+                info = self.repoInfo()
+                return info and info['topLevel']
+            if rest[:-1] in ([], ['--verify'], ['-q', '--verify']) and not rest[-1].startswith('-'):
+                result = self.objectInfo(rest[-1])
+                return result and result[0]
+        elif command == 'symbolic-ref' and rest == ['--short', 'HEAD']:
+            info = self.repoInfo()
+            if not info:
+                return None
+            with open(os.path.join(info['gitDir'], 'HEAD')) as f:
+                head = f.read().strip()
+            if head.startswith('ref: refs/heads/'):
+                return head[len('ref: refs/heads/'):]
+        elif command in ('show', 'log'):
+            prefix = {'show': ['-s', '--format='], 'log': ['-1', '--pretty=']}[command]
+            if len(rest) < 2 or rest[0] != prefix[0] or not rest[1].startswith(prefix[1]):
+                return None
+            fmt, revs = rest[1][len(prefix[1]):], rest[2:]
+            if len(revs) > 1 or (revs and revs[0].startswith('-')):
+                return None
+            result = self.readObject(revs[0] if revs else 'HEAD')
+            if not result or result[1] != 'commit':
+                return None
+            return formatCommit(result[0], result[2], fmt)
+        return None
 
     @rootRunnable
-    def call(self, args: List[Union[str, NamedVar]], exceptOnError: bool=True) -> None:
-        """Call a git command and wait for it to complete."""
+    def call(self, args: List[Union[str, NamedVar]], exceptOnError: bool=True) -> bool:
+        """Call a git command, wait for it to complete, and return True if successful."""
         argValues = varValues(args)
         command = 'git ' + ' '.join(argValues)
         if self.verbose:
@@ -109,9 +618,10 @@ class GitWrapper(object):
                 envVars += '; '
             displayCommand = '(%sgit %s)' % (envVars, ' '.join(varNames(args)))
             click.echo(displayCommand)
-        returncode = sp.Popen(['git'] + argValues, shell=False).wait()
+        returncode, output = self._run(argValues)
         if returncode != 0 and exceptOnError:
             raise click.ClickException("%s failed with error %d" % (command, returncode))
+        return returncode == 0
 
     @rootRunnable
     def callAndPipe(self, args: List[Union[str, NamedVar]], shellDesc: str, callbackFunc: Optional[Callable[[bytes], None]], stdout: BinaryIO=sp.PIPE) -> None:
@@ -124,62 +634,109 @@ class GitWrapper(object):
                 envVars += '; '
             displayCommand = '(%sgit %s)' % (envVars, ' '.join(varNames(args)))
             click.echo(displayCommand)
-        p = sp.Popen(['git'] + argValues, shell=False, stdout=stdout)
-        output, err = p.communicate()
-        if p.returncode != 0:
-            raise click.ClickException("%s failed with error %d" % (command, p.returncode))
+        key = self._queryKey('pipe', argValues) if stdout == sp.PIPE else None
+        output, generation = self._recall(key)
+        if output is None:
+            returncode, output = self._run(argValues, stdout=stdout)
+            if returncode != 0:
+                raise click.ClickException("%s failed with error %d" % (command, returncode))
+            self._remember(key, argValues, output, generation)
         if callbackFunc:
             callbackFunc(output)
 
     @rootRunnable
-    def callAndGetUtf8Var(self, args: List[Union[str, NamedVar]], varName: str) -> NamedVar:
-        """Call a git command, pipe the stdout, and return it."""
+    def callAndStream(self, args: List[Union[str, NamedVar]], shellDesc: str,
+            consumeFunc: Callable[[Iterator[bytes]], None], delimiter: bytes=b'\0') -> None:
+        """Call a git command and pass its stdout to a callback as a generator of records.
+
+        Records are yielded as soon as git writes them, so the output is never held in memory
+        as a whole. The callback must consume the generator before returning.
+        """
         argValues = varValues(args)
         command = 'git ' + ' '.join(argValues)
+        if self.verbose:
+            envVars = varGens(args)
+            if envVars:
+                envVars += '; '
+            displayCommand = '(%sgit %s)' % (envVars, ' '.join(varNames(args)))
+            click.echo(displayCommand)
+        start = time.perf_counter()
         p = sp.Popen(['git'] + argValues, shell=False, stdout=sp.PIPE)
-        output, err = p.communicate()
+        self.spawnCount += 1
+        bytesRead = 0
+        def records():
+            nonlocal bytesRead
+            pending = b''
+            while True:
+                chunk = p.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                bytesRead += len(chunk)
+                parts = (pending + chunk).split(delimiter)
+                pending = parts.pop()
+                yield from parts
+            if pending:
+                yield pending
+        try:
+            consumeFunc(records())
+        finally:
+            p.stdout.close()
+            p.wait()
+            self.invalidate(argValues)
+            if self.profiler:
+                self.profiler.record('git', 'git %s' % gitSubcommand(argValues)[0], start,
+                        p.returncode, bytesRead)
         if p.returncode != 0:
             raise click.ClickException("%s failed with error %d" % (command, p.returncode))
+
+    @rootRunnable
+    def callAndGetUtf8Var(self, args: List[Union[str, NamedVar]], varName: str) -> NamedVar:
+        """Call a git command, pipe the stdout, and return it."""
+        argValues = varValues(args)
         shellDesc = 'git %s' % ' '.join(varNames(args))
-        return NamedVar(varName, output.decode('utf-8').rstrip(), shellDesc)
+        return NamedVar(varName, self._query(argValues), shellDesc)
 
     @rootRunnable
-    def callAndGetUtf8(self, args: List[Union[str, NamedVar]], stdin: Optional[bytes]=None) -> str:
-        """Call a git command, pipe the stdout, and return the shell result as UTF-8."""
+    def callAndGetUtf8(self, args: List[Union[str, NamedVar]], stdin: Optional[bytes]=None,
+            env: Optional[dict]=None) -> str:
+        """Call a git command, pipe the stdout, and return the shell result as UTF-8.
+
+        Extra environment variables in env are set for the command, which is then never memoized.
+        """
         argValues = varValues(args)
+        if stdin is None and env is None:
+            return self._query(argValues)
         command = 'git ' + ' '.join(argValues)
-        p = sp.Popen(['git'] + argValues, shell=False, stdout=sp.PIPE, stdin=sp.PIPE)
-        output, err = p.communicate(input=stdin)
-        if p.returncode != 0:
-            raise click.ClickException("%s failed with error %d" % (command, p.returncode))
+        returncode, output = self._run(argValues, input=stdin, stdout=sp.PIPE,
+                stdin=None if stdin is None else sp.PIPE, env=env and dict(os.environ, **env))
+        if returncode != 0:
+            raise click.ClickException("%s failed with error %d" % (command, returncode))
         return output.decode('utf-8').rstrip()
 
+    @rootRunnable
+    def callAndGetOutput(self, args: List[Union[str, NamedVar]]) -> tuple:
+        """Call a git command that may fail, and return (True if successful, stdout as UTF-8)."""
+        argValues = varValues(args)
+        if self.verbose:
+            click.echo('(git %s)' % ' '.join(varNames(args)))
+        returncode, output = self._run(argValues, stdout=sp.PIPE)
+        return (returncode == 0, output.decode('utf-8').rstrip())
+
     @rootRunnable
     def callAndGetStatus(self, args: List[Union[str, NamedVar]]) -> bool:
         """Call a git command, pipe the stdout, and return True if successful."""
         argValues = varValues(args)
         command = 'git ' + ' '.join(argValues)
-        returncode = sp.Popen(
-                ['git'] + argValues, shell=False, stdout=sp.DEVNULL, stderr=sp.DEVNULL).wait()
-        return returncode == 0
+        key = self._queryKey('status', argValues)
+        success, generation = self._recall(key)
+        if success is None:
+            returncode, output = self._run(argValues, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+            success = returncode == 0
+            self._remember(key, argValues, success, generation)
+        return success
 
 passGitWrapper = click.make_pass_decorator(GitWrapper)
 
-def mergeWithFixes(pullRequest: PullRequest.PullRequest, commit_title: str,
-        commit_message: str, merge_method: str, sha: str):
-    """Fixed version of PyGithub merge with commit_title, merge_method, and sha."""
-    post_parameters = dict()
-    post_parameters["commit_title"] = commit_title
-    post_parameters["commit_message"] = commit_message
-    post_parameters["merge_method"] = merge_method
-    post_parameters["sha"] = sha
-    headers, data = pullRequest._requester.requestJsonAndCheck(
-	"PUT",
-	pullRequest.url + "/merge",
-	input=post_parameters
-    )
-    return github.PullRequestMergeStatus.PullRequestMergeStatus(pullRequest._requester, headers, data, completed=True)
-
 def notOnMaster(f):
     """Decorator that creates a new branch when a command is run from master."""
     @passGitWrapper
@@ -193,72 +750,569 @@ def notOnMaster(f):
     return update_wrapper(wrappedFunc, f)
 
 
-def requestReview(pullRequest: PullRequest.PullRequest, reviewers: List[str]):
-    """Request review for a pull request."""
-    post_parameters = dict()
-    post_parameters["reviewers"] = reviewers
-    headers, data = pullRequest._requester.requestJsonAndCheck(
-	"POST",
-	pullRequest.url + "/requested_reviewers",
-	input=post_parameters,
-        headers={'Accept': 'application/vnd.github.black-cat-preview+json'}
-    )
+def echoLines(lines: Iterator[str]) -> None:
+    """Echo lines as a generator produces them, writing in batches rather than line by line."""
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == ECHO_BATCH_SIZE:
+            click.echo('\n'.join(batch))
+            batch = []
+    if batch:
+        click.echo('\n'.join(batch))
+
+def githubApi():
+    """Import the GitHub-facing code, and with it PyGithub, only for commands that talk to GitHub."""
+    import gitate_github
+    return gitate_github
 
 def removeRevPrefix(text):
     """Remove rXX prefix from commit string."""
     return re.sub(r'^r\d+: ', '', text)
 
-def pushState(git: GitWrapper):
-    """Save current state by committing index and untracked files."""
-    stagedFiles = git.callAndGetUtf8(['diff', '--name-only', '--cached'])
-    if stagedFiles:
+def runConcurrently(*steps: Callable[[], object], maxWorkers: Optional[int]=None) -> list:
+    """Run independent steps on a thread pool and return their results in order.
+
+    Steps run inside the current click context so profiling and command lookups still work.
+    All steps finish before the first failure is raised.
+    """
+    ctx = click.get_current_context()
+    def inContext(step):
+        with ctx.scope(cleanup=False):
+            return step()
+    with ThreadPoolExecutor(max_workers=min(len(steps), maxWorkers or len(steps))) as executor:
+        futures = [executor.submit(inContext, step) for step in steps]
+    return [future.result() for future in futures]
+
+class RepoSnapshot(object):
+    """Branch, index and working tree state read from a single porcelain v2 status call."""
+    def __init__(self):
+        # Current branch, or None if HEAD is detached.
+        self.branch = None
+        # Maps of root-relative path to the index (X) or working tree (Y) status letter.
+        self.staged = {}
+        self.unstaged = {}
+        self.untracked = []
+
+    @staticmethod
+    def read(git: GitWrapper) -> 'RepoSnapshot':
+        """Build a snapshot from `git status --porcelain=v2 -z --branch`."""
+        snapshot = RepoSnapshot()
+        git.callAndPipe(['status', '--porcelain=v2', '-z', '--branch', '--untracked-files=all'],
+                'git status', snapshot.parse, fromRoot=True)
+        return snapshot
+
+    def parse(self, stdout: bytes) -> None:
+        for kind, code, path in RepoSnapshot.entries(iter(stdout.split(b'\0'))):
+            if kind == 'branch':
+                self.branch = path
+            elif kind == 'changed':
+                if code[0] != '.':
+                    self.staged[path] = code[0]
+                if code[1] != '.':
+                    self.unstaged[path] = code[1]
+            else:
+                self.untracked.append(path)
+
+    @staticmethod
+    def entries(records: Iterator[bytes]) -> Iterator[tuple]:
+        """Turn porcelain v2 -z records into (kind, code, path) tuples as they arrive.
+
+        kind is 'branch' (path is the branch, or None if HEAD is detached), 'changed' (code is
+        the two letter XY status) or 'untracked'.
+        """
+        for record in records:
+            record = record.decode('utf-8')
+            if record.startswith('# branch.head '):
+                head = record[len('# branch.head '):]
+                yield ('branch', None, None if head == '(detached)' else head)
+            elif record[:2] in ('1 ', '2 ', 'u '):
+                # Ordinary, renamed/copied and unmerged entries differ in the number of fields.
+                fieldCount = {'1': 9, '2': 10, 'u': 11}[record[0]]
+                fields = record.split(' ', fieldCount - 1)
+                if record[0] == '2':
+                    # Skip the original path of the rename or copy.
+                    next(records)
+                yield ('changed', fields[1], fields[-1])
+            elif record.startswith('? '):
+                yield ('untracked', None, record[2:])
+
+    def currentBranch(self) -> str:
+        """Return the current branch, failing like `git symbolic-ref` on a detached HEAD."""
+        if self.branch is None:
+            raise click.ClickException("HEAD is not on a branch")
+        return self.branch
+
+    def modifiedAndUntracked(self) -> List[str]:
+        """Paths `git ls-files --modified --others` would list, relative to the root."""
+        return sorted(set(self.unstaged) | set(self.untracked))
+
+    def isClean(self) -> bool:
+        return not (self.staged or self.unstaged or self.untracked)
+
+def stateRef(branch: str) -> str:
+    """Private ref recording the state commits pushState stacked on a branch."""
+    return 'refs/g8/state/%s' % branch
+
+def pushState(git: GitWrapper, snapshot: Optional[RepoSnapshot]=None):
+    """Save current state by committing index and untracked files.
+
+    The commits are built with write-tree and commit-tree, so no hooks run and the working tree
+    is never written. The branch moves to the new commits so checkout and rebase carry them,
+    and refs/g8/state/<branch> records them until popState.
+    """
+    if snapshot is None:
+        snapshot = RepoSnapshot.read(git)
+    branch = snapshot.currentBranch()
+    base = git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD'])
+    tip = base
+
+    if snapshot.staged:
         # Commit staged files.
-        git.call(['commit', '--quiet', '-m', STAGED_MESSAGE])
-
-    untrackedFiles = git.callAndGetUtf8(['ls-files', '--modified', '--others', '--exclude-standard'], fromRoot=True)
-    if untrackedFiles:
-        # Commit untracked files
-        git.call(['add', '--', '.'], fromRoot=True)
-        git.call(['commit', '--quiet', '-m', UNTRACKED_MESSAGE])
+        tree = git.callAndGetUtf8(['write-tree'])
+        tip = git.callAndGetUtf8(['commit-tree', tree, '-p', tip, '-m', STAGED_MESSAGE])
+
+    if snapshot.unstaged or snapshot.untracked:
+        # Commit untracked files from a copy of the index, taken under the index lock. The copy
+        # then replaces the index, which leaves the index matching the new commit with its stat
+        # information intact.
+        gitDir = git.repoInfo()['gitDir']
+        indexPath = os.path.join(gitDir, 'index')
+        lockPath = indexPath + '.lock'
+        try:
+            lock = os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            raise click.ClickException("Unable to create '%s': another git process seems to be running" % lockPath)
+        try:
+            with os.fdopen(lock, 'wb') as f, open(indexPath, 'rb') as index:
+                f.write(index.read())
+            env = {'GIT_INDEX_FILE': lockPath}
+            git.callAndGetUtf8(['add', '-A'], env=env)
+            tree = git.callAndGetUtf8(['write-tree'], env=env)
+            tip = git.callAndGetUtf8(['commit-tree', tree, '-p', tip, '-m', UNTRACKED_MESSAGE])
+            os.replace(lockPath, indexPath)
+        finally:
+            if os.path.exists(lockPath):
+                os.remove(lockPath)
+        git.invalidate(['update-index'])
+
+    if tip != base:
+        git.call(['update-ref', '-m', 'g8: save state', 'HEAD', tip, base])
+        git.call(['update-ref', stateRef(branch), tip])
+
+def stateCommits(git: GitWrapper, tip: str) -> tuple:
+    """Split a branch tip into (base, staged, untracked) around the state commits of pushState.
+
+    base is the last commit of the change itself, staged the commit holding the saved index (base
+    when there is none), and untracked whether a commit of untracked files sits on top.
+    """
+    # The state commits may have been rebased since pushState, so find them by message.
+    base = tip
+    untracked = False
+    if git.callAndGetUtf8(['show', '-s', '--format=%s', base]) == UNTRACKED_MESSAGE:
+        untracked = True
+        base = git.callAndGetUtf8(['rev-parse', '--verify', base + '~1'])
+    staged = base
+    if git.callAndGetUtf8(['show', '-s', '--format=%s', base]) == STAGED_MESSAGE:
+        base = git.callAndGetUtf8(['rev-parse', '--verify', base + '~1'])
+    return (base, staged, untracked)
 
 def popState(git: GitWrapper):
-    # Recover files and index stashed in the branch.
-    if git.callAndGetUtf8(['show', '-s', '--format=%s', 'HEAD']) == UNTRACKED_MESSAGE:
-        git.call(['reset', '--quiet', '--soft', 'HEAD~1'])
-        git.call(['reset', '--quiet'])
-    if git.callAndGetUtf8(['show', '-s', '--format=%s', 'HEAD']) == STAGED_MESSAGE:
-        git.call(['reset', '--quiet', '--soft', 'HEAD~1'])
-
-
-def getGithubRepo(git: GitWrapper) -> Repository.Repository:
-    """Read git credentials and return github Repo object."""
-    remote = git.callAndGetUtf8(['remote', 'get-url', 'origin'])
-
-    url = urlparse(remote)
-    fillInput = (
-        'protocol=%s\n' % url.scheme +
-        'host=%s\n' % url.netloc +
-        'path=%s\n' % url.path +
-        '\n'
-    ).encode('utf-8')
-            
-    fillOutput = git.callAndGetUtf8(['credential', 'fill'], stdin=fillInput)
-    creds = dict(re.findall(r'(\S+)=(\S+)', fillOutput))
-
-    github = Github(creds.get('username'), creds.get('password'))
-
-    orgName, repoName = url.path.strip('/').rstrip('.git').split('/', 1)
-    org = github.get_organization(orgName)
-    return org.get_repo(repoName)
+    """Recover files and index stashed in the branch with a single read-tree of the index."""
+    tip = git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD'])
+    base, staged, untracked = stateCommits(git, tip)
+
+    if base != tip:
+        git.call(['update-ref', '-m', 'g8: restore state', 'HEAD', base, tip])
+        if untracked:
+            # Untracked and unstaged files are already in the working tree; put the index back
+            # to the staged files, keeping stat information for unchanged entries.
+            git.call(['read-tree', '-m', staged + '^{tree}'])
+    branch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+    if git.callAndGetStatus(['show-ref', '--quiet', '--verify', stateRef(branch)]):
+        git.call(['update-ref', '-d', stateRef(branch)])
+
+
+def stackConfig(git: GitWrapper, name: str) -> dict:
+    """Map each branch to its branch.<branch>.<name> setting, for the branches that have one."""
+    values = {}
+    for entry in git.callAndGetUtf8(['config', '--list', '-z']).split('\0'):
+        key, _, value = entry.partition('\n')
+        if key.startswith('branch.') and key.endswith('.' + name):
+            values[key[len('branch.'):-len(name) - 1]] = value
+    return values
+
+def parentBranch(git: GitWrapper, branch: Optional[str]=None) -> str:
+    """Return the change branch is stacked on, master unless branch.<branch>.g8-parent says otherwise."""
+    if branch is None:
+        # Read HEAD directly rather than spending a git call on every status.
+        info = git.repoInfo()
+        try:
+            with open(os.path.join(info['gitDir'], 'HEAD')) as f:
+                head = f.read().strip()
+        except (OSError, TypeError):
+            head = ''
+        branch = head[len('ref: refs/heads/'):] if head.startswith('ref: refs/heads/') else None
+    return stackConfig(git, 'g8-parent').get(branch, 'master')
+
+def setParentBranch(git: GitWrapper, branch: str, parent: str) -> None:
+    if parent != 'master':
+        git.call(['config', 'branch.%s.g8-parent' % branch, parent])
+    elif branch in stackConfig(git, 'g8-parent'):
+        git.call(['config', '--unset', 'branch.%s.g8-parent' % branch])
+
+def unstack(git: GitWrapper, gone: dict, landed: bool) -> None:
+    """Stack the children of changes that are being deleted on their nearest remaining parent.
+
+    gone maps each deleted change to its tip. If the changes landed, their children also record
+    that tip as branch.<child>.g8-fork, so the next sync moves only the children's own commits.
+    """
+    parents = stackConfig(git, 'g8-parent')
+    for child, parent in sorted(parents.items()):
+        if child in gone or parent not in gone:
+            continue
+        newParent = parent
+        while newParent in gone:
+            newParent = parents.get(newParent, 'master')
+        setParentBranch(git, child, newParent)
+        if landed:
+            git.call(['config', 'branch.%s.g8-fork' % child, gone[parent]])
+
+def rebaseStack(git: GitWrapper, branch: str, busy: set) -> None:
+    """Rebase the stack holding branch, bottom up, onto wherever each change's parent now is.
+
+    Changes whose parent has not moved are left alone, so a sync costs a rebase per change that
+    actually needs one. A run of changes each stacked on the tip of the one below moves in a single
+    rebase --update-refs. Changes in busy are checked out elsewhere and are not touched.
+    """
+    parents = stackConfig(git, 'g8-parent')
+    forks = stackConfig(git, 'g8-fork')
+    refs = git.callAndGetUtf8(['for-each-ref', '--format=%(refname:short) %(objectname)', 'refs/heads'])
+    tips = dict([line.split(' ', 1) for line in splitIfNotEmpty(refs)])
+    def parentOf(change: str) -> str:
+        parent = parents.get(change, 'master')
+        return parent if parent in tips else 'master'
+    children = {}
+    for child in sorted(parents):
+        if child in tips:
+            children.setdefault(parentOf(child), []).append(child)
+
+    # Walk down to the change stacked on master, then collect every change above it, parents first.
+    root = branch
+    below = set([root])
+    while parentOf(root) != 'master' and parentOf(root) not in below:
+        root = parentOf(root)
+        below.add(root)
+    order = [root]
+    for change in order:
+        order.extend([x for x in children.get(change, []) if x not in order])
+
+    # Compare against each change's own commits, without the state commits of pushState.
+    contentTips = dict(zip(['master'] + order, runConcurrently(
+        *[lambda change=change: stateCommits(git, tips[change])[0] for change in ['master'] + order])))
+    bases = dict(zip(order, runConcurrently(*[lambda change=change: git.callAndGetUtf8(
+        ['merge-base', forks.get(change, contentTips[parentOf(change)]), tips[change]]) for change in order])))
+
+    done = set()
+    for change in order:
+        onto = contentTips[parentOf(change)]
+        if change in done or change in busy or bases[change] == onto:
+            continue
+        # Extend the run while the next change sits right on the tip of the last one.
+        chain = [change]
+        while True:
+            last = chain[-1]
+            above = children.get(last, [])
+            if (len(above) != 1 or above[0] in busy or above[0] in forks or
+                    contentTips[last] != tips[last] or bases[above[0]] != tips[last]):
+                break
+            chain.append(above[0])
+        click.echo('Rebasing %s onto %s' % (', '.join(chain), parentOf(change)))
+        git.call(['rebase', '--quiet', '--update-refs', '--onto', onto, bases[change], chain[-1]])
+        if change in forks:
+            git.call(['config', '--unset', 'branch.%s.g8-fork' % change])
+        done.update(chain)
+        for moved in chain:
+            tips[moved] = git.callAndGetUtf8(['rev-parse', '--verify', 'refs/heads/%s' % moved])
+            contentTips[moved] = stateCommits(git, tips[moved])[0]
+
+def replayChange(git: GitWrapper, base: str, tip: str, onto: str) -> tuple:
+    """Rebuild the first-parent commits of base..tip on top of onto without touching the working tree.
+
+    Every commit is a full revision of the change, so each one is merged with onto by merge-tree on
+    its own, against base; one merge-tree process does them all. The commits are then recreated
+    with their original author and message. Returns ({old id: new id}, None), or (None, conflicting paths)
+    when a merge conflicts. No ref is moved either way.
+    """
+    output = git.callAndGetUtf8(['log', '--first-parent', '--reverse', '--date=raw',
+        '--format=%H%x00%an%x00%ae%x00%ad%x00%B%x00', '%s..%s' % (base, tip)])
+    fields = output.split('\0')
+    commits = [(fields[i].lstrip('\n'), fields[i + 1], fields[i + 2], fields[i + 3], fields[i + 4])
+        for i in range(0, len(fields) - 4, 5)]
+    if not commits:
+        return ({}, None)
+
+    # merge-tree picks the merge base itself. Merging with a scratch commit that has both onto and
+    # base as parents makes it pick base, the old tip of the parent, rather than some older commit
+    # that onto and the change still share.
+    scratch = git.callAndGetUtf8(['commit-tree', onto + '^{tree}', '-p', onto, '-p', base, '-m', 'g8 sync'])
+    merges = git.callAndGetUtf8(['merge-tree', '--stdin', '--name-only', '--no-messages'],
+        stdin=''.join(['%s %s\n' % (scratch, commit[0]) for commit in commits]).encode('utf-8'))
+    # Each merge is its status, 1 if clean, the tree, then conflicted paths up to an empty field.
+    records = iter(merges.split('\0'))
+    trees = []
+    conflicts = []
+    for status in records:
+        if not status:
+            continue
+        trees.append(next(records))
+        for path in records:
+            if not path:
+                break
+            conflicts.append(path)
+    if conflicts:
+        return (None, sorted(set(conflicts)))
+
+    parent = onto
+    replayed = {}
+    signing = signingArgs(git)
+    for (sha, name, email, date, message), tree in zip(commits, trees):
+        env = {'GIT_AUTHOR_NAME': name, 'GIT_AUTHOR_EMAIL': email, 'GIT_AUTHOR_DATE': date}
+        parent = git.callAndGetUtf8(['commit-tree', tree, '-p', parent] + signing,
+            stdin=message.encode('utf-8'), env=env)
+        replayed[sha] = parent
+    return (replayed, None)
+
+def findForkPoint(git: GitWrapper, parent: Optional[str]=None) -> NamedVar:
+    """Find where HEAD forked from parent, reusing the answer while the refs and reflog are unchanged.
+
+    parent defaults to the change the current branch is stacked on.
+    """
+    if parent is None:
+        parent = parentBranch(git)
+    args = ['merge-base', '--fork-point', parent]
+    parentInfo = git.objectInfo('refs/heads/%s' % parent)
+    headInfo = git.objectInfo('HEAD')
+    if not git.useCache or not parentInfo or not headInfo:
+        return git.callAndGetUtf8Var(args, 'FORK')
+
+    # The fork point depends on the parent's reflog, so its size is part of the key.
+    reflog = os.path.join(git.repoInfo()['commonDir'], 'logs', 'refs', 'heads', parent)
+    reflogSize = os.stat(reflog).st_size if os.path.exists(reflog) else 0
+    key = '%s %s %s %d' % (parent, parentInfo[0], headInfo[0], reflogSize)
+
+    cache = git.readCache('fork-point.json')
+    if key in cache:
+        git.countCache('fork-point', True)
+        return NamedVar('FORK', cache[key], 'git %s' % ' '.join(args))
+    git.countCache('fork-point', False)
+
+    forkPoint = git.callAndGetUtf8Var(args, 'FORK')
+    cache[key] = forkPoint.value
+    # Keep the most recently added entries.
+    git.writeCache('fork-point.json', dict(list(cache.items())[-FORK_POINT_CACHE_SIZE:]))
+    return forkPoint
+
+def indexEntryCount(git: GitWrapper) -> Optional[int]:
+    """Read the number of entries from the index header, or None outside a repository."""
+    info = git.repoInfo()
+    if not info:
+        return None
+    try:
+        with open(os.path.join(info['gitDir'], 'index'), 'rb') as f:
+            signature, version, count = struct.unpack('>4sII', f.read(12))
+    except (OSError, struct.error):
+        return 0
+    return count if signature == b'DIRC' else 0
+
+def perfSettings(git: GitWrapper) -> List[tuple]:
+    """Return (key, current value or None, recommended value) for each supported PERF_SETTINGS entry."""
+    config = {}
+    for line in splitIfNotEmpty(git.callAndGetUtf8(['config', '--list'])):
+        key, _, value = line.partition('=')
+        config[key.lower()] = value
+    buildOptions = git.callAndGetUtf8(['version', '--build-options'])
+    settings = []
+    for key, value in PERF_SETTINGS:
+        if key == 'core.fsmonitor' and 'fsmonitor--daemon' not in buildOptions:
+            continue
+        settings.append((key, config.get(key.lower()), value))
+    return settings
+
+def applyPerfSettings(git: GitWrapper, settings: List[tuple]) -> None:
+    """Set the given settings and bring the index up to date with them."""
+    keys = set()
+    for key, current, value in settings:
+        git.call(['config', key, value])
+        keys.add(key)
+    # Rewrite the index now rather than on the next write, so the first scan already benefits.
+    # Only touch what was just set; the settings left alone may be the user's own choice.
+    indexOptions = []
+    if 'index.version' in keys:
+        indexOptions += ['--index-version', dict(PERF_SETTINGS)['index.version']]
+    if 'core.untrackedCache' in keys:
+        indexOptions.append('--untracked-cache')
+    if indexOptions:
+        git.call(['update-index'] + indexOptions)
+    if 'core.fsmonitor' in keys:
+        git.call(['fsmonitor--daemon', 'start'])
+
+def offerPerfSettings(git: GitWrapper) -> None:
+    """Once per repository, offer the settings in PERF_SETTINGS if the repository is large."""
+    count = indexEntryCount(git)
+    if not count or count < LARGE_REPO_FILES:
+        return
+    missing = [x for x in perfSettings(git) if (x[1] or '').lower() != x[2]]
+    if not missing or git.callAndGetUtf8(['config', '--bool', '--default', 'false', '--get', 'g8.perfOffered']) == 'true':
+        return
+    click.echo('This repository has %d files. These settings make status scans much faster:' % count)
+    for key, current, value in missing:
+        click.echo('  %s = %s' % (key, value))
+    if click.confirm('Enable them?', default=True):
+        applyPerfSettings(git, missing)
+    else:
+        click.echo("Run 'g8 doctor --perf' to enable them later.")
+    git.call(['config', 'g8.perfOffered', 'true'])
+
+class WorktreePool(object):
+    """Worktrees that each hold one change, used when `git config g8.worktrees` is true.
+
+    Changes are checked out once into their own worktree under g8.worktreeDir (by default
+    .git/g8/worktrees), so switching changes is a cd rather than a checkout. At most
+    g8.worktreePool worktrees are kept; past that, the least recently used one has its state
+    saved with pushState and is switched to the new change.
+    """
+    def __init__(self, root: str, size: int):
+        self.root = root
+        self.size = size
+
+    @staticmethod
+    def forRepo(git: GitWrapper) -> Optional['WorktreePool']:
+        """Return the pool, or None if worktree mode is off."""
+        def config(key, default, *options):
+            return git.callAndGetUtf8(['config'] + list(options) + ['--default', default, '--get', key])
+        if config('g8.worktrees', 'false', '--bool') != 'true':
+            return None
+        root = config('g8.worktreeDir', os.path.join(git.repoInfo()['commonDir'], 'g8', 'worktrees'), '--path')
+        return WorktreePool(os.path.abspath(root), int(config('g8.worktreePool', str(WORKTREE_POOL_DEFAULT), '--int')))
+
+    def worktrees(self, git: GitWrapper) -> List[dict]:
+        """Every worktree of the repository as {'path', 'branch'}, branch None when detached."""
+        output = git.callAndGetUtf8(['worktree', 'list', '--porcelain', '-z'])
+        worktrees = []
+        for record in output.split('\0'):
+            if record.startswith('worktree '):
+                worktrees.append({'path': record[len('worktree '):], 'branch': None})
+            elif record.startswith('branch refs/heads/'):
+                worktrees[-1]['branch'] = record[len('branch refs/heads/'):]
+        return worktrees
+
+    def managed(self, git: GitWrapper) -> List[dict]:
+        return [x for x in self.worktrees(git) if os.path.dirname(x['path']) == self.root]
+
+    def find(self, git: GitWrapper, branch: str) -> Optional[str]:
+        """Return the worktree branch is checked out in, managed or not."""
+        for worktree in self.worktrees(git):
+            if worktree['branch'] == branch:
+                return worktree['path']
+        return None
+
+    def touch(self, git: GitWrapper, path: str) -> None:
+        lastUsed = git.readCache('worktrees.json')
+        lastUsed[path] = time.time()
+        git.writeCache('worktrees.json', lastUsed)
+
+    def _inWorktree(self, path: str, func: Callable[[], None]) -> None:
+        currentDir = os.getcwd()
+        os.chdir(path)
+        try:
+            func()
+        finally:
+            os.chdir(currentDir)
+
+    def checkout(self, git: GitWrapper, branch: str) -> str:
+        """Return a worktree holding branch, reusing, adding or evicting one as needed."""
+        path = self.find(git, branch)
+        if path:
+            self.touch(git, path)
+            return path
+
+        managed = self.managed(git)
+        idle = [x['path'] for x in managed if x['branch'] is None]
+        if idle:
+            path = idle[0]
+        elif len(managed) < self.size:
+            slots = set(os.path.basename(x['path']) for x in managed)
+            path = os.path.join(self.root, next(str(i) for i in range(len(slots) + 1) if str(i) not in slots))
+            os.makedirs(self.root, exist_ok=True)
+            git.call(['worktree', 'add', '--quiet', path, branch])
+            self._inWorktree(path, lambda: popState(git))
+            self.touch(git, path)
+            return path
+        else:
+            # Evict the least recently used worktree that the caller is not standing in.
+            lastUsed = git.readCache('worktrees.json')
+            currentRoot = git.callAndGetUtf8(['rev-parse', '--show-toplevel'])
+            candidates = [x['path'] for x in managed if x['path'] != currentRoot]
+            if not candidates:
+                raise click.ClickException("No worktree can be evicted; raise g8.worktreePool")
+            path = min(candidates, key=lambda x: lastUsed.get(x, 0))
+            self._inWorktree(path, lambda: pushState(git))
+
+        def switch():
+            git.call(['checkout', '--quiet', branch])
+            popState(git)
+        self._inWorktree(path, switch)
+        self.touch(git, path)
+        return path
+
+    def release(self, git: GitWrapper, branch: str) -> Optional[str]:
+        """Save and detach the managed worktree holding branch so it can be reused."""
+        path = self.find(git, branch)
+        if not path or os.path.dirname(path) != self.root:
+            return None
+        def detach():
+            pushState(git)
+            git.call(['checkout', '--quiet', '--detach'])
+        self._inWorktree(path, detach)
+        self.prune(git)
+        return path
+
+    def prune(self, git: GitWrapper) -> None:
+        """Remove idle worktrees beyond the pool size."""
+        managed = self.managed(git)
+        lastUsed = git.readCache('worktrees.json')
+        idle = sorted([x['path'] for x in managed if x['branch'] is None], key=lambda x: lastUsed.get(x, 0))
+        for path in idle[:max(0, len(managed) - self.size)]:
+            git.call(['worktree', 'remove', '--force', path])
+            lastUsed.pop(path, None)
+        git.writeCache('worktrees.json', lastUsed)
 
 @click.group(add_help_option=True)
 @click.pass_context
 @click.option('--verbose', '-v', is_flag=True, help='Verbose output, echo git commands')
-def cli(ctx, verbose):
+@click.option('--no-cache', is_flag=True, help='Ignore results cached in .git/g8')
+@click.option('--profile', is_flag=True, help='Time git calls and GitHub requests, print a summary')
+@click.option('--profile-trace', type=click.Path(dir_okay=False), metavar='FILE',
+        help='Also write a Chrome trace of the profile to FILE')
+def cli(ctx, verbose, no_cache, profile, profile_trace):
     """Command-line tool for the 8th Wall source repository."""
 
-    ctx.obj = GitWrapper(verbose=verbose)
-    pass
+    ctx.obj = GitWrapper(verbose=verbose, useCache=not no_cache)
+    ctx.call_on_close(ctx.obj.close)
+    ctx.call_on_close(ctx.obj.reportCacheStats)
+
+    if profile or profile_trace:
+        profiler = Profiler()
+        ctx.obj.profiler = profiler
+        def report():
+            click.echo(profiler.summary(), err=True)
+            if profile_trace:
+                profiler.writeTrace(profile_trace)
+        ctx.call_on_close(report)
+
+    if ctx.invoked_subcommand in SCANNING_COMMANDS and os.isatty(0):
+        offerPerfSettings(ctx.obj)
 
 @cli.command()
 @click.pass_context
@@ -271,17 +1325,33 @@ def help(ctx, command):
         ctx.info_name = command
         click.echo(cli.commands[command].get_help(ctx))
 
-def deleteFeature(git: GitWrapper, change: str):
-    """Delete the local branch, remote branch, and pull requests."""
-    # TODO(mc) For diffbase, make this the parent branch, not just master.
-    currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
-
-    # Switch to master if we are deleting the active branch.
-    if currentBranch == change:
-        git.call(['checkout', 'master', '--quiet'])
+def deleteFeature(git: GitWrapper, change: str, landed: bool=False):
+    """Delete the local branch, remote branch, and pull requests.
 
-    # Delete the local branch.
+    Changes stacked on it move to its parent; if it landed, they drop its commits on the next sync.
+    """
+    currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+    parent = parentBranch(git, change)
+
+    pool = WorktreePool.forRepo(git)
+    released = pool and pool.release(git, change)
+    if released:
+        # The change's worktree is now idle; move to the one holding its parent if we were in it.
+        if released == git.callAndGetUtf8(['rev-parse', '--show-toplevel']):
+            parentDir = pool.find(git, parent) or pool.find(git, 'master')
+            if parentDir:
+                os.chdir(parentDir)
+                commandParent(['cd', parentDir])
+    elif currentBranch == change:
+        # Switch to the parent if we are deleting the active branch.
+        git.call(['checkout', parent, '--quiet'])
+
+    tip = git.callAndGetUtf8(['rev-parse', '--verify', 'refs/heads/%s' % change])
+    unstack(git, {change: stateCommits(git, tip)[0]}, landed)
+
+    # Delete the local branch and any state recorded for it.
     git.call(['branch', '-D', change])
+    git.call(['update-ref', '-d', stateRef(change)])
 
     # Get current user.
     user = getpass.getuser()
@@ -302,12 +1372,16 @@ def deleteFeature(git: GitWrapper, change: str):
 
 
 @cli.command()
+@passGitWrapper
 @click.pass_context
 @click.option('-m', '--move', is_flag=True, help='Move modified files into the change')
-def new(ctx, move):
+@click.option('-s', '--stack', is_flag=True, help='Stack the change on the current one')
+def new(ctx, git, move, stack):
     """Create a new change and switch to it."""
-    name = randomWord(5)
-    ctx.invoke(change, force=True, move=move, delete=False, change=name)
+    # Read all existing branches once so the new name never collides.
+    branches = git.callAndGetUtf8(['for-each-ref', '--format=%(refname:short)', 'refs/heads'])
+    name = randomWord(5, set(splitIfNotEmpty(branches)))
+    ctx.invoke(change, force=True, move=move, delete=False, stack=stack, change=name)
 
 @cli.command()
 @passGitWrapper
@@ -317,25 +1391,157 @@ def deleteme(ctx, git):
     currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
     ctx.invoke(change, force=False, move=False, delete=True, change=currentBranch)
 
+@cli.command()
+@passGitWrapper
+def gc(git):
+    """Delete all changes that have landed or have no commits."""
+    pool = WorktreePool.forRepo(git)
+    checkedOut = set([x['branch'] for x in pool.worktrees(git)]) if pool else set(
+        [git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])])
+
+    refs = git.callAndGetUtf8(['for-each-ref', 'refs/heads',
+        '--format=%(refname:short)%00%(objectname)%00%(contents:subject)'])
+    changes = {}
+    for branch, sha, subject in [x.split('\0') for x in splitIfNotEmpty(refs)]:
+        if branch == 'master':
+            continue
+        if branch in checkedOut:
+            click.echo('Skipping %s, it is checked out' % branch)
+        elif subject in (STAGED_MESSAGE, UNTRACKED_MESSAGE):
+            # Files stashed by pushState have not been sent anywhere, so keep the change.
+            click.echo('Skipping %s, it has uncommitted files' % branch)
+        else:
+            changes[branch] = sha
+    if not changes:
+        click.echo('No changes to clean up')
+        return
+
+    # A change is abandoned if it has no commits of its own.
+    mergeBases = dict([(branch, git.callAndGetUtf8(['merge-base', 'master', sha]))
+        for branch, sha in changes.items()])
+    abandoned = [branch for branch, sha in changes.items() if mergeBases[branch] == sha]
+
+    # A change has landed if its squashed diff matches the patch-id of a commit on master's
+    # first-parent history since it forked. diff-tree compares each tip with its merge base,
+    # so patch-id reports the change by its tip.
+    pending = [branch for branch in changes if branch not in abandoned]
+    landed = []
+    if pending:
+        def patchIds(diff: str) -> dict:
+            output = git.callAndGetUtf8(['patch-id', '--stable'], stdin=diff.encode('utf-8'))
+            return dict([x.split(' ') for x in splitIfNotEmpty(output)])
+        branchDiffs = git.callAndGetUtf8(['diff-tree', '-p', '--stdin'], stdin=''.join(
+            ['%s %s\n' % (changes[branch], mergeBases[branch]) for branch in pending]).encode('utf-8'))
+        masterDiffs = git.callAndGetUtf8(['log', '--first-parent', '--no-merges', '-p', '--format=%H',
+            'master', '--not'] + sorted(set([mergeBases[branch] for branch in pending])))
+        masterPatches = set(patchIds(masterDiffs))
+        branchPatches = dict([(sha, patch) for patch, sha in patchIds(branchDiffs).items()])
+        landed = [branch for branch in pending if branchPatches.get(changes[branch]) in masterPatches]
+
+    for branch in sorted(landed):
+        click.echo('Landed:    %s' % branch)
+    for branch in sorted(abandoned):
+        click.echo('Abandoned: %s' % branch)
+    doomed = sorted(landed + abandoned)
+    if not doomed:
+        click.echo('No changes to clean up')
+        return
+    click.confirm('Delete %d changes?' % len(doomed), abort=True)
+    unstack(git, dict([(branch, changes[branch]) for branch in doomed]), landed=True)
+
+    # Delete the local branches, and any state recorded for them, in one transaction.
+    stateRefs = set(splitIfNotEmpty(git.callAndGetUtf8(['for-each-ref', '--format=%(refname)', 'refs/g8/state'])))
+    transaction = ['delete refs/heads/%s %s' % (branch, changes[branch]) for branch in doomed]
+    transaction += ['delete %s' % stateRef(branch) for branch in doomed if stateRef(branch) in stateRefs]
+    git.callAndGetUtf8(['update-ref', '--stdin'], stdin=('\n'.join(transaction) + '\n').encode('utf-8'))
+    configNames = splitIfNotEmpty(git.callAndGetUtf8(['config', '--list', '--name-only']))
+    for branch in doomed:
+        if any(x.startswith('branch.%s.' % branch) for x in configNames):
+            git.call(['config', '--remove-section', 'branch.%s' % branch])
+
+    # Delete the remote branches the last fetch saw with a single push.
+    user = getpass.getuser()
+    remoteRefs = set(splitIfNotEmpty(git.callAndGetUtf8(
+        ['for-each-ref', '--format=%(refname:lstrip=3)', 'refs/remotes/origin'])))
+    remoteBranches = ['%s.%s' % (user, branch) for branch in doomed if '%s.%s' % (user, branch) in remoteRefs]
+    if remoteBranches:
+        git.call(['push', '--quiet', 'origin', '--delete'] + remoteBranches)
+    click.echo('Deleted %d changes' % len(doomed))
+
+@cli.command()
+@passGitWrapper
+@click.option('--perf', is_flag=True, help='Time the scans status and change depend on, before and after')
+def doctor(git, perf):
+    """Check the settings that keep g8 fast in large repositories."""
+    count = indexEntryCount(git)
+    if count is None:
+        raise click.ClickException('Not in a git repository')
+    click.echo('Index: %d files%s' % (count, ', large repository' if count >= LARGE_REPO_FILES else ''))
+    settings = perfSettings(git)
+    for key, current, value in settings:
+        ok = (current or '').lower() == value
+        click.echo('  %-20s %-8s %s' % (key, current or 'unset', 'ok' if ok else 'recommended: ' + value))
+    missing = [x for x in settings if (x[1] or '').lower() != x[2]]
+
+    # The scans status reads the working tree with, which pushState and change also rely on.
+    scans = [
+        ('status', ['status', '--porcelain=v2', '-z', '--untracked-files=all']),
+        ('diff', ['diff', '--cached', '--name-status', '-z', 'HEAD']),
+    ]
+    def timeScans():
+        # Every sample must run the scan rather than recall the first one.
+        git.memoize = False
+        timings = []
+        for name, args in scans:
+            samples = []
+            for i in range(PERF_SAMPLES + 1):
+                start = time.perf_counter()
+                git.callAndPipe(args, 'git ' + ' '.join(args), None)
+                samples.append((time.perf_counter() - start) * 1000)
+            timings.append(sorted(samples[1:])[PERF_SAMPLES // 2])
+        return timings
+
+    before = timeScans() if perf else None
+    if missing and click.confirm('Enable the recommended settings?', default=True):
+        applyPerfSettings(git, missing)
+        git.call(['config', 'g8.perfOffered', 'true'])
+    elif perf:
+        for (name, args), ms in zip(scans, before):
+            click.echo('%-8s %8.1f ms' % (name, ms))
+        return
+    if perf:
+        after = timeScans()
+        click.echo('%-8s %10s %10s' % ('scan', 'before', 'after'))
+        for (name, args), old, new in zip(scans, before, after):
+            click.echo('%-8s %7.1f ms %7.1f ms' % (name, old, new))
+
 @cli.command()
 @passGitWrapper
 @click.pass_context
 @click.option('-f', '--force', is_flag=True, help='Create change if it does not exist')
 @click.option('-m', '--move', is_flag=True, help='Move modified files into the change')
 @click.option('-d', '--delete',  is_flag=True, help='Delete change')
+@click.option('-s', '--stack', is_flag=True, help='Stack a newly created change on the current one')
 @click.argument('change')
-def change(ctx, git, force, move, delete, change):
+def change(ctx, git, force, move, delete, stack, change):
     """Switch to a new change."""
+    pool = WorktreePool.forRepo(git)
+    if pool and not move:
+        changeWorktree(ctx, git, pool, force, delete, stack, change)
+        return
 
     # Ensure master is clean. 
-    currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+    snapshot = RepoSnapshot.read(git)
+    currentBranch = snapshot.currentBranch()
+    parent = currentBranch if stack else 'master'
+    if force:
+        # Read where the parent is now; saving state below adds commits to the current branch.
+        parentTip = git.callAndGetUtf8(['rev-parse', '--verify', parent])
     if change == 'master' and move:
         raise click.ClickException("Cannot move changes into master")
 
     if currentBranch == 'master' and not move:
-        stagedFiles = git.callAndGetUtf8(['diff', '--name-only', '--cached'])
-        untrackedFiles = git.callAndGetUtf8(['ls-files', '--modified', '--others', '--exclude-standard'], fromRoot=True)
-        if stagedFiles or untrackedFiles:
+        if not snapshot.isClean():
             raise click.ClickException("master has modifications, move files with the change using '-m'.")
 
     if not force:
@@ -357,7 +1563,7 @@ def change(ctx, git, force, move, delete, change):
     os.chdir(rootDir)
 
     if not move:
-        pushState(git)
+        pushState(git, snapshot)
 
     try:
         if delete:
@@ -368,10 +1574,10 @@ def change(ctx, git, force, move, delete, change):
                 return
         if force and not git.callAndGetStatus(['show-ref', '--quiet', 'refs/heads/%s' % change]):
             try:
-                # TODO(mc): Change this support branching not only from master.
-                if currentBranch != 'master':
-                    git.call(['checkout', 'master', '--quiet'])
-                git.call(['checkout', '--quiet', '-b', change])
+                if currentBranch != parent:
+                    git.call(['checkout', parent, '--quiet'])
+                git.call(['checkout', '--quiet', '-b', change, parentTip])
+                setParentBranch(git, change, parent)
                 ctx.invoke(status)
                 click.echo('Switched to a new branch \'%s\'' % change);
             finally:
@@ -392,92 +1598,264 @@ def change(ctx, git, force, move, delete, change):
             # Tell the parent shell to cd to the root directory.
             commandParent(['cd', rootDir])
 
+def changeWorktree(ctx, git: GitWrapper, pool: WorktreePool, force: bool, delete: bool, stack: bool,
+        change: str):
+    """Switch to a change by moving to its worktree, leaving the current one untouched."""
+    if delete:
+        if change == 'master':
+            raise click.ClickException("master cannot be deleted.")
+        if click.confirm('Delete change %s?' % change, abort=True):
+            deleteFeature(git, change)
+        return
+
+    exists = git.callAndGetStatus(['show-ref', '--quiet', '--verify', 'refs/heads/%s' % change])
+    if not exists and not force:
+        raise click.ClickException('Change \'%s\' does not exist' % change)
+    if not exists:
+        parent = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD']) if stack else 'master'
+        git.call(['branch', change, parent])
+        setParentBranch(git, change, parent)
+
+    path = pool.checkout(git, change)
+    if path != git.callAndGetUtf8(['rev-parse', '--show-toplevel']):
+        os.chdir(path)
+        commandParent(['cd', path])
+    ctx.invoke(status)
+    click.echo('Switched to %s \'%s\'' % ('branch' if exists else 'a new branch', change))
+
 @cli.command()
 @passGitWrapper
 def status(git):
     """Show all unsubmitted changes to the change."""
-    # Find the fork point for this branch.
-    # TODO(mc): Change this to pass in the mainline branch that we started this change from,
-    # currently it is hardcoded as master.
-    forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
+    # Find the fork point for this branch from the change it is stacked on.
+    forkPoint = findForkPoint(git)
 
     RED = '\033[31m'
     GREEN = '\033[32m'
     NOCOLOR = '\033[0m'
 
-    shellDesc = 'xargs -I{} echo "%s{}"'
-    def colorStatus(color):
-        def func(stdout: bytes):
-            output = stdout.decode('utf-8').rstrip()
-            if output:
-                lines = output.replace('\t', ' ').split('\n')
-                click.echo('\n'.join([' ' + color + x[0] + NOCOLOR + ' ' + x[1:] for x in lines]))
-        return func
-
     # Output tracked and committed files between staging and master.
-    git.callAndPipe(['diff', forkPoint, '--cached', '--name-status'], shellDesc, colorStatus(GREEN))
-
-    # Output files that are modified in the working directory.
-    git.callAndPipe(['diff', '--name-status'], shellDesc, colorStatus(RED))
-
+    def colorStaged(records):
+        for record in records:
+            # Each status letter record is followed by one path, or two for renames and copies.
+            code = record.decode('utf-8')
+            paths = [next(records).decode('utf-8') for i in range(2 if code[0] in 'RC' else 1)]
+            yield ' ' + GREEN + code[0] + NOCOLOR + ' ' + code[1:] + ' ' + ' '.join(paths)
+    git.callAndStream(['diff', forkPoint, '--cached', '--name-status', '-z'], 'git diff',
+            lambda records: echoLines(colorStaged(records)))
+
+    # Output files that are modified in the working directory, then new files, in one pass.
     untrackedPrefix = ' %s?%s  ' % (RED, NOCOLOR)
-    shellDesc = 'xargs -I{} echo "%s{}"' % untrackedPrefix
-    def listUntracked(stdout: bytes):
-        output = stdout.decode('utf-8').rstrip()
-        if output:
-            lines = output.split('\n')
-            click.echo('\n'.join([untrackedPrefix + x for x in lines]))
-    # Output new files.
-    git.callAndPipe(['ls-files', '--others', '--exclude-standard'], shellDesc,
-            listUntracked, fromRoot=True)
+    def colorWorkingTree(records):
+        for kind, code, path in RepoSnapshot.entries(records):
+            if kind == 'changed' and code[1] != '.':
+                yield ' ' + RED + code[1] + NOCOLOR + '  ' + path
+            elif kind == 'untracked':
+                yield untrackedPrefix + path
+    git.callAndStream(['status', '--porcelain=v2', '-z', '--untracked-files=all'], 'git status',
+            lambda records: echoLines(colorWorkingTree(records)), fromRoot=True)
 
 def interactiveFileList(git, message):
     """List all modified, deleted, added or untracked files, and allow customization."""
-    # Find the fork point for this branch.
-    # TODO(mc): Change this to pass in the mainline branch that we started this change from,
-    # currently it is hardcoded as master.
-    forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
+    # Find the fork point for this branch from the change it is stacked on.
+    forkPoint = findForkPoint(git)
 
-    updatedFiles = set(splitIfNotEmpty(git.callAndGetUtf8(['diff', forkPoint, '--cached', '--name-only'])))
-    newFiles = set(splitIfNotEmpty(git.callAndGetUtf8(['ls-files', '--modified', '--others', '--exclude-standard'], fromRoot=True)))
-    allFiles = sorted(list(set(list(updatedFiles) + list(newFiles))))
+    # Both lists are sorted, which keeps every step below linear in the number of paths.
+    updatedFiles = splitPaths(git.callAndGetUtf8(['diff', forkPoint, '--cached', '--name-only', '-z']))
+    newFiles = RepoSnapshot.read(git).modifiedAndUntracked()
+    allFiles = sortedUnion(updatedFiles, newFiles)
 
     indexFile = tempfile.NamedTemporaryFile()
 
     with open(indexFile.name, "wb") as f:
         f.write(('# %s\n' % message).encode('utf-8'))
-        f.write('\n'.join(allFiles).encode('utf-8'))
+        f.write('\n'.join([quotePath(x) for x in allFiles]).encode('utf-8'))
 
     EDITOR=os.environ.get('EDITOR', 'vi')
     returncode = sp.Popen([EDITOR, indexFile.name], shell=False).wait()
     if returncode != 0:
         raise click.ClickException("File edit failed with error %d" % (p.returncode))
 
-    userFiles = set()
+    userFiles = []
     with open(indexFile.name, "rb") as f:
-        for line in f.readlines():
+        for line in f:
             strippedLine = line.decode('utf-8').strip()
-            if strippedLine.startswith('#'):
+            if not strippedLine or strippedLine.startswith('#'):
                 continue
-            userFiles.add(strippedLine)
+            userFiles.append(unquotePath(strippedLine))
+    userFiles = sortedUnion(sorted(userFiles), [])
+
+    deleteFiles = sortedDifference(updatedFiles, userFiles)
+    addFiles = sortedIntersection(newFiles, userFiles)
+
+    return (addFiles, deleteFiles)
 
-    addFiles = []
-    deleteFiles = []
+def splitPaths(output: str) -> List[str]:
+    """Split the NUL-terminated paths of a -z git command."""
+    return output.split('\0')[:-1] if output else []
+
+def quotePath(path: str) -> str:
+    """Quote a path for the file list editor if a line could not hold it verbatim."""
+    if (path != path.strip() or path.startswith(('#', '"')) or
+            any(ord(c) < 32 or c in '\\\x7f' for c in path)):
+        return json.dumps(path, ensure_ascii=False)
+    return path
+
+def unquotePath(line: str) -> str:
+    return json.loads(line) if line.startswith('"') else line
+
+def sortedUnion(a: List[str], b: List[str]) -> List[str]:
+    """Merge two sorted path lists, dropping duplicates."""
+    result = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j == len(b) or (i < len(a) and a[i] < b[j]):
+            path = a[i]
+            i += 1
+        else:
+            path = b[j]
+            j += 1
+        if not result or result[-1] != path:
+            result.append(path)
+    return result
 
-    for oneFile in updatedFiles:
-        if not oneFile in userFiles:
-            deleteFiles.append(oneFile)
+def sortedDifference(a: List[str], b: List[str]) -> List[str]:
+    """Paths of sorted list a that are not in sorted list b."""
+    result = []
+    j = 0
+    for path in a:
+        while j < len(b) and b[j] < path:
+            j += 1
+        if j == len(b) or b[j] != path:
+            result.append(path)
+    return result
 
-    for oneFile in newFiles:
-        if oneFile in userFiles:
-            addFiles.append(oneFile)
+def sortedIntersection(a: List[str], b: List[str]) -> List[str]:
+    """Paths of sorted list a that are also in sorted list b."""
+    result = []
+    j = 0
+    for path in a:
+        while j < len(b) and b[j] < path:
+            j += 1
+        if j < len(b) and b[j] == path:
+            result.append(path)
+    return result
 
-    return (addFiles, deleteFiles)
+def applyToPaths(git: GitWrapper, args: List[Union[str, NamedVar]], paths: List[str]) -> None:
+    """Run a git command on root-relative paths passed on stdin, so any number of paths fits."""
+    git.callAndGetUtf8(['--literal-pathspecs'] + args + ['--pathspec-from-file=-', '--pathspec-file-nul'],
+            stdin=''.join([x + '\0' for x in paths]).encode('utf-8'), fromRoot=True)
+
+def syncAll(git: GitWrapper) -> None:
+    """Fast-forward master and rebase every change in memory, then move all their refs at once.
+
+    Changes are replayed a level of the stacks at a time, the changes of a level in parallel. A
+    change that conflicts keeps its commits, as do the changes stacked on it, and is reported.
+    Only the current branch's files are updated.
+    """
+    pool = WorktreePool.forRepo(git)
+    rootDir = git.callAndGetUtf8(['rev-parse', '--show-toplevel'])
+    snapshot = RepoSnapshot.read(git)
+    currentBranch = snapshot.currentBranch()
+    elsewhere = dict([(x['branch'], x['path']) for x in pool.worktrees(git) if x['path'] != rootDir]) if pool else {}
+
+    git.call(['fetch'])
+    masterTip = git.callAndGetUtf8(['rev-parse', '--verify', 'refs/heads/master'])
+    upstream = git.callAndGetUtf8(['rev-parse', '--verify', 'master@{upstream}'])
+    updates = {}
+    if upstream != masterTip:
+        if not git.callAndGetStatus(['merge-base', '--is-ancestor', masterTip, upstream]):
+            raise click.ClickException("master has commits that are not upstream, it cannot be fast-forwarded.")
+        if currentBranch == 'master' or 'master' in elsewhere:
+            # Master's files are checked out, so let git move them with the branch.
+            git.call((['-C', elsewhere['master']] if 'master' in elsewhere else []) + ['merge', '--ff-only', '--quiet'])
+        else:
+            updates['master'] = (upstream, masterTip)
+        masterTip = upstream
+
+    currentDir = os.getcwd()
+    if currentBranch != 'master':
+        # Save local files in the branch so they move with it.
+        os.chdir(rootDir)
+        pushState(git, snapshot)
+    try:
+        parents = stackConfig(git, 'g8-parent')
+        forks = stackConfig(git, 'g8-fork')
+        refs = git.callAndGetUtf8(['for-each-ref', '--format=%(refname:short) %(objectname)', 'refs/heads'])
+        tips = dict([line.split(' ', 1) for line in splitIfNotEmpty(refs)])
+        def parentOf(change: str) -> str:
+            parent = parents.get(change, 'master')
+            return parent if parent in tips else 'master'
+        changes = [x for x in sorted(tips) if x != 'master']
+        for change in changes:
+            if change in elsewhere:
+                click.echo('Skipping %s, it is checked out in %s' % (change, elsewhere[change]))
+
+        # Where each change's own commits end, before any state commits, and where it forked.
+        contentTips = dict(zip(changes, runConcurrently(
+            *[lambda change=change: stateCommits(git, tips[change])[0] for change in changes],
+            maxWorkers=SYNC_WORKERS))) if changes else {}
+        contentTips['master'] = masterTip
+        bases = dict(zip(changes, runConcurrently(*[lambda change=change: git.callAndGetUtf8(
+            ['merge-base', forks.get(change, contentTips[parentOf(change)]), tips[change]]) for change in changes],
+            maxWorkers=SYNC_WORKERS))) if changes else {}
+
+        def replay(change: str) -> tuple:
+            onto = contentTips[parentOf(change)]
+            if change in elsewhere or (bases[change] == onto and change not in forks):
+                return (None, None)
+            return replayChange(git, bases[change], tips[change], onto)
+
+        # Replay each level once the level below it has its new tips.
+        conflicts = {}
+        level = [x for x in changes if parentOf(x) == 'master']
+        seen = set(level)
+        while level:
+            results = runConcurrently(*[lambda change=change: replay(change) for change in level],
+                maxWorkers=SYNC_WORKERS)
+            for change, (replayed, conflict) in zip(level, results):
+                if conflict:
+                    conflicts[change] = conflict
+                elif replayed is not None:
+                    onto = contentTips[parentOf(change)]
+                    updates[change] = (replayed.get(tips[change], onto), tips[change])
+                    contentTips[change] = replayed.get(contentTips[change], onto)
+            level = [x for x in changes if x not in seen and parentOf(x) in level]
+            seen.update(level)
+
+        for change, paths in sorted(conflicts.items()):
+            click.echo('Conflict:  %s in %s' % (change, ', '.join(paths)))
+        if not updates:
+            click.echo('All changes are up to date')
+            return
+        # Move every ref in one transaction, which fails as a whole if any of them moved meanwhile.
+        git.callAndGetUtf8(['update-ref', '-m', 'g8: sync --all', '--stdin'], stdin=''.join(
+            ['update refs/heads/%s %s %s\n' % (branch, new, old) for branch, (new, old) in sorted(updates.items())]
+        ).encode('utf-8'))
+        for change in sorted(updates):
+            if change != 'master':
+                click.echo('Rebased:   %s onto %s' % (change, parentOf(change)))
+                if change in forks:
+                    git.call(['config', '--unset', 'branch.%s.g8-fork' % change])
+        if currentBranch in updates:
+            # Bring the checked out files along; the state commits keep them clean until popState.
+            new, old = updates[currentBranch]
+            git.call(['read-tree', '-m', '-u', old, new])
+    finally:
+        if currentBranch != 'master':
+            popState(git)
+            if not os.path.isdir(currentDir):
+                # Tell the parent shell to leave a directory the rebase removed.
+                commandParent(['cd', rootDir])
 
 @cli.command()
 @passGitWrapper
-def sync(git):
-    """Sync latest updates from server and rebase."""
+@click.option('-a', '--all', 'everything', is_flag=True, help='Rebase every change without checking them out')
+def sync(git, everything):
+    """Sync latest updates from server and rebase the stack of the current change."""
+    if everything:
+        syncAll(git)
+        return
 
     # Get the current branch.
     currentBranch = git.callAndGetUtf8Var(['symbolic-ref', '--short', 'HEAD'], 'CURRENT')
@@ -488,13 +1866,19 @@ def sync(git):
     rootDir = git.callAndGetUtf8(['rev-parse', '--show-toplevel'])
     needsDirChange = False
 
+    # In worktree mode master may be checked out in another worktree; move it forward there.
+    pool = WorktreePool.forRepo(git)
+    masterDir = pool and pool.find(git, 'master')
+    masterElsewhere = bool(masterDir) and masterDir != rootDir
+
     if not currentBranchIsMaster:
         # Switch to root dir.
         os.chdir(rootDir)
         # Save state in the current branch.
         pushState(git)
-        # Switch to the master branch.
-        git.call(['checkout', 'master'])
+        if not masterElsewhere:
+            # Switch to the master branch.
+            git.call(['checkout', 'master'])
 
     # Sync remote state.
     git.call(['fetch'])
@@ -505,10 +1889,10 @@ def sync(git):
         # Move the master branch forward. This must be a fast-forward as we
         # shouldn't be committing to master.
         # TODO(mc): Should this be a rebase if the current branch is master?
-        git.call(['merge', '--ff-only'])
+        git.call((['-C', masterDir] if masterElsewhere else []) + ['merge', '--ff-only'])
         masterAdvanced = True
     finally:
-        if not currentBranchIsMaster:
+        if not currentBranchIsMaster and not masterElsewhere:
             # Check whether directory to return to exists.
             needsDirChange = not os.path.isdir(currentDir)
 
@@ -517,9 +1901,11 @@ def sync(git):
 
     try:
         if (not currentBranchIsMaster) and masterAdvanced:
-            # Rebase off master.
-            # TODO(mc): Change this behavior to support diffbase.
-            git.call(['rebase', '--quiet', '--onto', 'master', 'master', currentBranch])
+            # Rebase the changes of the stack whose parents moved, then come back to this one.
+            busy = set([x['branch'] for x in pool.worktrees(git) if x['path'] != rootDir]) if pool else set()
+            rebaseStack(git, currentBranch.value, busy)
+            if git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD']) != currentBranch.value:
+                git.call(['checkout', '--quiet', currentBranch])
     finally:
         if not currentBranchIsMaster:
             # Recover state.
@@ -533,10 +1919,32 @@ def sync(git):
 
 @cli.command()
 @passGitWrapper
-def ls(git):
+@click.option('-r', '--remote', is_flag=True, help='Show pull request review, merge and CI state')
+def ls(git, remote):
     """List all changes."""
-    #git.call(['branch']):
-    git.call(['for-each-ref','refs/heads','--format=%(HEAD) %(refname:short) \t%(contents:subject)'])
+    if not remote:
+        #git.call(['branch']):
+        git.call(['for-each-ref','refs/heads','--format=%(HEAD) %(refname:short) \t%(contents:subject)'])
+        return
+
+    refs = git.callAndGetUtf8(['for-each-ref', 'refs/heads', '--format=%(HEAD)%00%(refname:short)%00%(contents:subject)'])
+    changes = [line.split('\0') for line in splitIfNotEmpty(refs)]
+    user = getpass.getuser()
+    remoteBranches = ['%s.%s' % (user, branch) for _, branch, _ in changes if branch != 'master']
+    pulls = githubApi().GithubSession.forRemote(git).pullStatus(git, remoteBranches) if remoteBranches else {}
+
+    for head, branch, subject in changes:
+        pull = pulls.get('%s.%s' % (user, branch))
+        if pull:
+            state = '#%d %s, %s, checks %s' % (pull['number'],
+                (pull['review'] or 'no review').lower().replace('_', ' '),
+                pull['mergeable'].lower(),
+                (pull['checks'] or 'none').lower())
+        elif branch == 'master':
+            state = ''
+        else:
+            state = 'not sent'
+        click.echo('%s %s \t%s\t%s' % (head, branch, subject, state))
 
 @cli.command()
 @passGitWrapper
@@ -578,10 +1986,8 @@ def abort_if_false(ctx, param, value):
 @click.argument('path', type=click.Path(exists=False), nargs=-1)
 def revert(git, path):
     """Revert local edits and undo index changes."""
-    # Find the fork point for this branch.
-    # TODO(mc): Change this to pass in the mainline branch that we started this
-    # change from, currently it is hardcoded as master.
-    forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
+    # Find the fork point for this branch from the change it is stacked on.
+    forkPoint = findForkPoint(git)
 
     if not path:
         # TODO(mc) Make this say Revert all files in 'change'
@@ -595,54 +2001,76 @@ def revert(git, path):
             # Revert modifications in newly unstaged files due to reset.
             git.call(['checkout', '--', '.'])
     else:
-        revertedFiles = []
-        try:
-            # For added files, reset the index and leave them untracked.
-            gitDiff = splitIfNotEmpty(git.callAndGetUtf8(
-                ['diff', forkPoint, '--name-status', '--'] + list(path)))
-            allFiles = sorted([tuple(x.split(None, 1)) for x in gitDiff])
-            groupedFiles = dict([(label, [val for _lab,val in value]) for (label, value) in
-                    groupby(allFiles, lambda x:x[0])])
-            if 'A' in groupedFiles:
-                addedFiles = groupedFiles['A']
-                # Revert adds by resetting the index (leaving the working copy).
-                git.call(['reset', '--quiet', forkPoint, '--'] + addedFiles)
-                revertedFiles.extend(addedFiles)
-            if 'M' in groupedFiles:
-                modifiedFiles = groupedFiles['M']
-                # Reset any potential index differences.
-                git.call(['reset', '--quiet', forkPoint, '--'] + modifiedFiles)
-                # Change the working copy to the fork-point version.
-                git.call(['checkout', forkPoint, '--'] + modifiedFiles)
-                revertedFiles.extend(modifiedFiles)
-            if 'D' in groupedFiles:
-                deletedFiles = groupedFiles['D']
-                # Reset any potential deletes in the index.
-                git.call(['reset', '--quiet', forkPoint, '--'] + deletedFiles)
-                # Recover the fork-point versions and add them to the working directory.
-                git.call(['checkout', forkPoint, '--'] + deletedFiles)
-                revertedFiles.extend(deletedFiles)
-
-            currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
-            if currentBranch != 'master':
-                # Find any files that require a commit to revert.
-                justFiles = [x[1] for x in allFiles]
-                revertDiff = git.callAndGetUtf8(['diff', '--cached', '--name-only', '--'] + justFiles)
-                if revertDiff:
-                    # Commit any reverts in the index.
-                    revertsToCommit = revertDiff.split('\n')
-                    git.call(['commit', '-m', 'Revert files.', '--'] + revertsToCommit)
-                    revertedFiles.extend(revertsToCommit)
-        finally:
-            for revertedFile in revertedFiles:
-                click.echo('Reverted ' + revertedFile)
+        # Classify the requested paths against the fork point. Renames and copies get both names;
+        # the old name is restored and the new one untracked, like a delete plus an add.
+        restore = []
+        untrack = []
+        def classify(records):
+            for record in records:
+                code = record.decode('utf-8')
+                paths = [next(records).decode('utf-8') for i in range(2 if code[0] in 'RC' else 1)]
+                if code[0] == 'A':
+                    untrack.append(paths[0])
+                elif code[0] in 'MTD':
+                    restore.append(paths[0])
+                elif code[0] == 'R':
+                    restore.append(paths[0])
+                    untrack.append(paths[1])
+                elif code[0] == 'C':
+                    untrack.append(paths[1])
+        git.callAndStream(['diff', forkPoint, '--name-status', '-z', '-M', '--'] + list(path), 'git diff', classify)
+        if not restore and not untrack:
+            return
+
+        # Read the fork-point entries of the paths to restore, in one listing per chunk of
+        # LS_TREE_PATHS paths to stay clear of the argument length limit.
+        restore = sortedUnion(sorted(restore), [])
+        wanted = set(restore)
+        entries = []
+        for i in range(0, len(restore), LS_TREE_PATHS):
+            listing = git.callAndGetUtf8(['ls-tree', '-r', '-z', forkPoint, '--'] + restore[i:i + LS_TREE_PATHS],
+                    fromRoot=True)
+            entries += [x for x in splitPaths(listing) if x.split('\t', 1)[1] in wanted]
+        # Index lines: the fork-point mode, object and path, or mode 0 and the null object name,
+        # as long as the fork point's under SHA-1 or SHA-256, to drop the path.
+        indexInfo = [entry.split(' ', 1)[0] + ' ' + entry.split(' ', 2)[2] for entry in entries]
+        nullObject = '0' * len(forkPoint.value)
+        indexInfo += ['0 %s\t%s' % (nullObject, x) for x in untrack]
+        indexInput = ''.join([x + '\0' for x in indexInfo]).encode('utf-8')
+
+        # Rewrite the index, then write the restored files from it.
+        git.callAndGetUtf8(['update-index', '-z', '--index-info'], stdin=indexInput, fromRoot=True)
+        if restore:
+            git.callAndGetUtf8(['checkout-index', '-f', '-u', '-z', '--stdin'],
+                    stdin=''.join([x + '\0' for x in restore]).encode('utf-8'), fromRoot=True)
+
+        currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+        if currentBranch != 'master':
+            # Commit the reverted paths alone: apply the same entries to HEAD's tree in a
+            # scratch index, so other staged changes stay staged.
+            scratchIndex = os.path.join(git.repoInfo()['gitDir'], 'g8-revert-index')
+            try:
+                env = {'GIT_INDEX_FILE': scratchIndex}
+                git.callAndGetUtf8(['read-tree', 'HEAD'], env=env)
+                git.callAndGetUtf8(['update-index', '-z', '--index-info'], stdin=indexInput, env=env)
+                tree = git.callAndGetUtf8(['write-tree'], env=env)
+            finally:
+                if os.path.exists(scratchIndex):
+                    os.remove(scratchIndex)
+            if tree != git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD^{tree}']):
+                # Run the hooks git commit would, as send does.
+                runHook(git, 'pre-commit')
+                commitIndex(git, tree, composeMessage(git, 'Revert files.', edit=False))
+
+        for revertedFile in sortedUnion(restore, sorted(untrack)):
+            click.echo('Reverted ' + revertedFile)
 
 
 @cli.command(help="Show changes between working tree and parent.")
 @passGitWrapper
 @click.argument('path', type=click.Path(exists=True), nargs=-1)
 def diff(git, path):
-    forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
+    forkPoint = findForkPoint(git)
     git.call(['diff', forkPoint, '--'] + list(path))
 
 def commaList(ctx, param, value):
@@ -651,19 +2079,85 @@ def commaList(ctx, param, value):
         return []
     return value.split(',')
 
+def runHook(git: GitWrapper, name: str, *args: str) -> None:
+    """Run a git hook if it is installed, failing the way git commit would."""
+    hooksDir = git.callAndGetUtf8(['rev-parse', '--git-path', 'hooks'])
+    if os.access(os.path.join(hooksDir, name), os.X_OK):
+        if not git.call(['hook', 'run', name, '--'] + list(args), exceptOnError=False):
+            raise click.ClickException("%s hook failed" % name)
+
+def commentChar(git: GitWrapper, message: str) -> str:
+    """The character that starts comment lines in the message template, from core.commentChar."""
+    char = git.callAndGetUtf8(['config', '--default', '#', '--get', 'core.commentChar'])
+    if char != 'auto':
+        return char
+    used = {line[:1] for line in message.split('\n')}
+    return next((c for c in AUTO_COMMENT_CHARS if c not in used), '#')
+
+def cleanMessage(text: str, comment: Optional[str] = None) -> str:
+    """Strip trailing spaces and extra blank lines like git commit's default cleanup, and lines
+    starting with comment if given."""
+    lines = []
+    for line in text.split('\n'):
+        if comment and line.startswith(comment):
+            continue
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def composeMessage(git: GitWrapper, message: str, edit: bool) -> str:
+    """Return a commit message, running the message hooks and optionally the editor on it."""
+    path = os.path.join(git.repoInfo()['gitDir'], 'COMMIT_EDITMSG')
+    # Like git commit, only strip comments when the editor showed the template explaining them.
+    comment = commentChar(git, message) if edit else None
+    with open(path, 'w') as f:
+        f.write(message + COMMIT_TEMPLATE.format(comment) if edit else message)
+    runHook(git, 'prepare-commit-msg', path, *(['message'] if message else []))
+    if edit:
+        editor = git.callAndGetUtf8(['var', 'GIT_EDITOR'])
+        returncode = sp.call(['sh', '-c', editor + ' "$@"', editor, path])
+        if returncode != 0:
+            raise click.ClickException("Commit message edit failed with error %d" % returncode)
+    with open(path) as f:
+        message = cleanMessage(f.read(), comment)
+    if not message:
+        raise click.ClickException("Aborting commit due to empty commit message.")
+    with open(path, 'w') as f:
+        f.write(message)
+    runHook(git, 'commit-msg', path)
+    with open(path) as f:
+        return cleanMessage(f.read(), comment)
+
+def signingArgs(git: GitWrapper) -> List[str]:
+    """commit-tree options that sign like git commit does when commit.gpgSign is set."""
+    if git.callAndGetUtf8(['config', '--bool', '--default', 'false', '--get', 'commit.gpgSign']) != 'true':
+        return []
+    return ['-S' + git.callAndGetUtf8(['config', '--default', '', '--get', 'user.signingKey'])]
+
+def commitIndex(git: GitWrapper, tree: str, message: str) -> str:
+    """Commit tree on top of HEAD as a single commit object and move the branch to it."""
+    head = git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD'])
+    sha = git.callAndGetUtf8(['commit-tree', tree, '-p', head] + signingArgs(git), stdin=message.encode('utf-8'))
+    subject = message.split('\n', 1)[0]
+    git.call(['update-ref', '-m', 'commit: %s' % subject, 'HEAD', sha, head])
+    runHook(git, 'post-commit')
+    branch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+    click.echo('[%s %s] %s' % (branch, sha[:7], subject))
+    return sha
+
 @cli.command(help="Send changes to remote and notify reviewers.")
 @notOnMaster
 @passGitWrapper
 @click.option('-t', '--to', callback=commaList, metavar='USER1,USER2', help='List of reviewers')
 @click.option('-u', '--update',  is_flag=True, help='Update commit message and files.')
 def send(git, to, update):
-    # Find the fork point for this branch.
-    # TODO(mc): Change this to pass in the mainline branch that we started this change from,
-    # currently it is hardcoded as master.
-    forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
-
-    # Find the current branch.
+    # Find the current branch, the change it is stacked on and where it forked from it.
     currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
+    parent = parentBranch(git, currentBranch)
+    forkPoint = findForkPoint(git, parent)
 
     revHashes = re.findall(r'([0-9a-f]+) r(\d+): .*', git.callAndGetUtf8(['log', '--pretty=%h %s', '%s..HEAD' % forkPoint.value]))
 
@@ -679,106 +2173,140 @@ def send(git, to, update):
     
     (addFiles, deleteFiles) = interactiveFileList(git, 'The following files will be included in the commit.')
     if addFiles:
-        git.call(['add', '--'] + addFiles, fromRoot=True)
+        applyToPaths(git, ['add'], addFiles)
     if deleteFiles:
-        git.call(['reset', forkPoint, '--'] + deleteFiles, fromRoot=True)
-
-    # Commit them in a new squashed commit.
-    if revHashes:
-        # Get the commit message from the last revision.
-        desc = git.callAndGetUtf8(['log', '-1', '--pretty=%s', lastRev])
-
-        # Strip the revision prefix.
-        strippedDesc = removeRevPrefix(desc)
-
-        # Create a new commit that strips the commit prefix.
-        git.call(['commit', '-q', '--allow-empty', '-m', strippedDesc])
-        
-        try:
-            if update:
-                # Edit the commit message.
-                git.call(['commit', '--allow-empty', '--amend', '-c', 'HEAD'])
-        finally:
-            # Make sure that we put back the revision prefix.
-            desc = git.callAndGetUtf8(['log', '-1', '--pretty=%s'])
-            git.call(['commit', '--allow-empty', '--amend', '-m', 'r%d: %s' % (revNumber, desc)])
-
+        applyToPaths(git, ['reset', '--quiet', forkPoint], deleteFiles)
+
+    # Commit them in a new squashed commit, built once with the revision prefix in place.
+    runHook(git, 'pre-commit')
+    tree = git.callAndGetUtf8(['write-tree'])
+    if not revHashes and tree == git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD^{tree}']):
+        raise click.ClickException("Nothing to commit, select the files to send.")
+    if revHashes and not update and tree == git.callAndGetUtf8(['rev-parse', '--verify', lastRev + '^{tree}']):
+        # Nothing changed since the last revision, so send it again as is.
+        click.echo('No changes since r%d' % (revNumber - 1))
     else:
-        # Commit with a new commit message.
-        git.call(['commit', '-q'])
-
-        # Append r0, r1, r2, etc to the commit message.
-        desc = git.callAndGetUtf8(['log', '-1', '--pretty=%s'])
-        git.call(['commit', '--amend', '-m', 'r%d: %s' % (revNumber, desc)])
+        if revHashes:
+            # Start from the message of the last revision, without its revision prefix.
+            message = removeRevPrefix(git.callAndGetUtf8(['log', '-1', '--pretty=%B', lastRev]))
+        else:
+            message = ''
+        message = composeMessage(git, message, edit=update or not revHashes)
+        # Prefix r0, r1, r2, etc to the commit message.
+        commitIndex(git, tree, 'r%d: %s' % (revNumber, message))
 
 
     # Get current user.
     user = getpass.getuser()
 
     remoteBranch = '%s.%s' % (user, currentBranch)
+    # A stacked change is reviewed against its parent's branch.
+    baseBranch = 'master' if parent == 'master' else '%s.%s' % (user, parent)
+    if not revHashes and baseBranch != 'master' and not git.callAndGetUtf8(
+            ['for-each-ref', '--format=%(objectname)', 'refs/remotes/origin/%s' % baseBranch]):
+        raise click.ClickException("%s is stacked on %s, send that first." % (currentBranch, parent))
+
+    def push():
+        # Skip the upload if the remote-tracking ref says the remote already has this commit.
+        known = git.callAndGetUtf8(['for-each-ref', '--format=%(objectname)', 'refs/remotes/origin/%s' % remoteBranch])
+        if known and known == git.callAndGetUtf8(['rev-parse', '--verify', 'HEAD']):
+            click.echo('origin/%s is up to date' % remoteBranch)
+            return
+        # Send that commit to the remote server, unless someone else pushed since we last saw it.
+        lease = '--force-with-lease=%s:%s' % (remoteBranch, known)
+        pushed, report = git.callAndGetOutput(
+                ['push', '--porcelain', lease, 'origin', '%s:%s' % (currentBranch, remoteBranch)])
+        if pushed:
+            click.echo('Pushed %s to origin/%s' % (currentBranch, remoteBranch))
+            return
+        # Rejected refs are reported as "!<tab>from:to<tab>summary (reason)"; git prints other errors itself.
+        rejections = [line.split('\t')[-1] for line in report.split('\n') if line.startswith('!')]
+        if any('(stale info)' in x for x in rejections):
+            raise click.ClickException("origin/%s changed since it was last fetched. "
+                    "Run 'git fetch' and check it before sending again." % remoteBranch)
+        raise click.ClickException("Pushing to origin/%s failed%s" % (
+                remoteBranch, ': ' + '; '.join(rejections) if rejections else ''))
 
-    # Send that commit to the remote server.
-    git.call(['push', '--force', 'origin', '%s:%s' % (currentBranch, remoteBranch)])
-
-    if not revHashes:
-        # If this is the first call to g8 send, create a pull request.
-        subject = removeRevPrefix(git.callAndGetUtf8(['log', '-1', '--pretty=%s']))
-        body = git.callAndGetUtf8(['log', '-1', '--pretty=%b'])
-        repo = getGithubRepo(git)
+    if revHashes:
+        push()
+    else:
+        # If this is the first call to g8 send, create a pull request. Read the GitHub credentials
+        # first, as git credential fill may prompt on the terminal the push also uses. Then look
+        # up the repository and read the message while the push is in flight; the pull request
+        # needs the pushed branch.
+        githubApi().GithubSession.forRemote(git).client(git)
+        _, repo, subject, body = runConcurrently(
+            push,
+            lambda: githubApi().getGithubRepo(git),
+            lambda: git.callAndGetUtf8(['log', '-1', '--pretty=%s']),
+            lambda: git.callAndGetUtf8(['log', '-1', '--pretty=%b']),
+        )
         pullRequest = repo.create_pull(
-            title=subject,
+            title=removeRevPrefix(subject),
             body=body,
             head=remoteBranch,
-            base='master',
+            base=baseBranch,
         )
+        githubApi().GithubSession.forRemote(git).rememberPullRequest(git, remoteBranch, pullRequest, pullRequest.etag)
         if to:
             # Create a review request.
-            requestReview(pullRequest, to)
+            githubApi().requestReview(pullRequest, to)
 
 @cli.command(help="Merge and commit the change, then clean up.")
 @notOnMaster
 @passGitWrapper
 @click.pass_context
-def land(ctx, git):
+@click.option('--timeout', default=PULL_POLL_TIMEOUT, metavar='SECONDS', help='How long to wait for the GitHub merge check')
+def land(ctx, git, timeout):
     currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
-
-    repo = getGithubRepo(git)
-
-    commitSha = git.callAndGetUtf8(['log', '-1', '--pretty=%H'])
+    parent = parentBranch(git, currentBranch)
+    if parent != 'master':
+        raise click.ClickException("%s is stacked on %s, land that first." % (currentBranch, parent))
+    gh = githubApi()
 
     user = getpass.getuser()
     remoteBranch = '%s.%s' % (user, currentBranch)
+    session = gh.GithubSession.forRemote(git)
+
+    # Read the local commit while GitHub answers.
+    (pullRequest, etag), commitSha, subject, body = runConcurrently(
+        lambda: session.openPullRequest(git, remoteBranch),
+        lambda: git.callAndGetUtf8(['log', '-1', '--pretty=%H']),
+        lambda: git.callAndGetUtf8(['log', '-1', '--pretty=%s']),
+        lambda: git.callAndGetUtf8(['log', '-1', '--pretty=%b']),
+    )
 
-    # Query for open pull requests in the branch.
-    pullFilter = '8thwall:%s' % remoteBranch
-    pagenatedRequests = repo.get_pulls(head=pullFilter)
-    pullRequests = []
-    for pr in pagenatedRequests:
-        pullRequests.append(pr)
-
-    if len(pullRequests) == 0:
+    if pullRequest is None:
         # Send current commit if there is no pull request.
         needsSend = True
         if not click.confirm('Land %s without review?' % currentBranch, abort=True):
             return
-    elif len(pullRequests) == 1:
-        pullRequest = pullRequests[0]
+    else:
         # Send current commit if it doesn't match remote.
         needsSend = (pullRequest.head.sha != commitSha)
-    else:
-        raise click.ClickException("More than one open pull request in " + remoteBranch)
     if needsSend:
         ctx.invoke(send, to=None, update=False)
         currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
         commitSha = git.callAndGetUtf8(['log', '-1', '--pretty=%H'])
-        pullRequest = repo.get_pulls(head=pullFilter)[0]
-
-    if pullRequest.mergeable == None:
-        click.echo('Waiting for GitHub merge check')
-    while pullRequest.mergeable == None:
-        click.echo('=', nl=False)
-        time.sleep(.1)
-        pullRequest = repo.get_pulls(head=pullFilter)[0]
+        subject = git.callAndGetUtf8(['log', '-1', '--pretty=%s'])
+        body = git.callAndGetUtf8(['log', '-1', '--pretty=%b'])
+        pullRequest, etag = session.openPullRequest(git, remoteBranch)
+        if pullRequest is None:
+            raise click.ClickException("No open pull request for " + remoteBranch)
+
+    def waitMergeable():
+        waitStart = time.perf_counter()
+        result = gh.waitForPullRequest(pullRequest, etag, gh.mergeabilityKnown, 'GitHub merge check', timeout)
+        if git.profiler:
+            git.profiler.record('wait', 'wait mergeable', waitStart, None, 0)
+        return result
+
+    # While GitHub computes mergeability, fetch for the sync below and scan for leftover files.
+    pullRequest, _, leftovers = runConcurrently(
+        waitMergeable,
+        lambda: git.call(['fetch', '--quiet']),
+        lambda: RepoSnapshot.read(git).modifiedAndUntracked(),
+    )
 
     if pullRequest.mergeable == False:
         raise click.ClickException("Pull request is not mergeable. Try 'g8 sync'.")
@@ -789,11 +2317,9 @@ def land(ctx, git):
         raise click.ClickException("Remote does not match local commit. Try 'g8 send'")
 
     # Merge the branch.
-    subject = removeRevPrefix(git.callAndGetUtf8(['log', '-1', '--pretty=%s']))
-    body = git.callAndGetUtf8(['log', '-1', '--pretty=%b'])
-    mergeResult = mergeWithFixes(
+    mergeResult = gh.mergeWithFixes(
         pullRequest,
-        commit_title=subject,
+        commit_title=removeRevPrefix(subject),
         commit_message=body,
         merge_method='squash',
         sha=commitSha,
@@ -801,16 +2327,14 @@ def land(ctx, git):
 
     if not mergeResult.merged:
         raise click.ClickException("Merge failed with message %s" % (command, returncode))
+    session.forgetPullRequest(git, remoteBranch)
 
-    untrackedFiles = git.callAndGetUtf8([
-        'ls-files', '--modified', '--others', '--exclude-standard'
-    ], fromRoot=True)
-    if not untrackedFiles:
+    if not leftovers:
         # Delete the branch if there are no files left.
-        deleteFeature(git, currentBranch)
+        deleteFeature(git, currentBranch, landed=True)
     else:
         # Find the commit this forks from.
-        forkPoint = git.callAndGetUtf8Var(['merge-base', '--fork-point', 'master'], 'FORK')
+        forkPoint = findForkPoint(git)
         # Reset all commits that were squashed and committed.
         git.call(['reset', '--quiet', '--mixed', forkPoint])
 
@@ -825,18 +2349,14 @@ def resend(git, to):
     """Add more reviewers to pull request."""
     currentBranch = git.callAndGetUtf8(['symbolic-ref', '--short', 'HEAD'])
 
-    repo = getGithubRepo(git)
-    commitSha = git.callAndGetUtf8(['log', '-1', '--pretty=%H'])
-    subject = removeRevPrefix(git.callAndGetUtf8(['log', '-1', '--pretty=%s']))
-    body = git.callAndGetUtf8(['log', '-1', '--pretty=%b'])
-
+    gh = githubApi()
     user = getpass.getuser()
     remoteBranch = '%s.%s' % (user, currentBranch)
 
-    # Assumes there is one-and-only-one pull request in this branch.
-    pullFilter = '8thwall:%s' % remoteBranch
-    pullRequest = repo.get_pulls(head=pullFilter)[0]
-    requestReview(pullRequest, to)
+    pullRequest, _ = gh.GithubSession.forRemote(git).openPullRequest(git, remoteBranch)
+    if pullRequest is None:
+        raise click.ClickException("No open pull request for %s. Try 'g8 send'" % remoteBranch)
+    gh.requestReview(pullRequest, to)
 
 
 if __name__ == '__main__':
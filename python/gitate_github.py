@@ -0,0 +1,336 @@
+"""GitHub-facing parts of g8: the API session, pull request polling and merging.
+
+Imported by gitate.githubApi() only in commands that talk to GitHub, so local commands never
+pay for importing PyGithub and its HTTP stack.
+"""
+
+import click
+import json
+import os
+import random
+import re
+import time
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+import github
+from github import Github
+from github import Repository
+from github import PullRequest
+from github import Requester
+from urllib.parse import urlparse
+if TYPE_CHECKING:
+    from gitate import GitWrapper
+    from gitate import Profiler
+
+# GitHub API endpoint, overridable for GitHub Enterprise or a local fake.
+GITHUB_API_ENV = 'G8_GITHUB_API'
+GITHUB_API_DEFAULT = 'https://api.github.com'
+
+# Seconds that repository metadata fetched from GitHub is reused from .git/g8.
+GITHUB_REPO_TTL = 24 * 60 * 60
+
+# Seconds that pull request review, merge and CI state shown by 'g8 ls --remote' is reused.
+PULL_STATUS_TTL = 60
+
+# Fields read for each change's open pull request, aliased per branch in one GraphQL query.
+PULL_STATUS_FIELDS = '''
+    nodes {
+      number
+      url
+      reviewDecision
+      mergeable
+      commits(last: 1) { nodes { commit { statusCheckRollup { state } } } }
+    }
+'''
+
+# Pull request polling: first and longest delay, in seconds.
+PULL_POLL_INITIAL = .25
+PULL_POLL_MAX = 5
+
+# Whether PyGithub requests are already being recorded by a profiler.
+_watched = False
+
+def githubPath(url: str) -> str:
+    """Reduce a GitHub API URL to a route, e.g. /repos/:repo/pulls/:n."""
+    path = re.sub(r'^/repos/[^/]+/[^/]+', '/repos/:repo', urlparse(url).path)
+    return re.sub(r'/\d+(?=/|$)', '/:n', path)
+
+def watchRequests(profiler: 'Profiler') -> None:
+    """Time every PyGithub request, once per process."""
+    global _watched
+    if _watched:
+        return
+    _watched = True
+    requestJson = Requester.Requester.requestJson
+    def timedRequestJson(requester, verb, url, *args, **kwargs):
+        start = time.perf_counter()
+        status, output = None, ''
+        try:
+            status, headers, output = requestJson(requester, verb, url, *args, **kwargs)
+            return (status, headers, output)
+        finally:
+            profiler.record('github', '%s %s' % (verb, githubPath(url)), start, status, len(output))
+    Requester.Requester.requestJson = timedRequestJson
+
+def mergeWithFixes(pullRequest: PullRequest.PullRequest, commit_title: str,
+        commit_message: str, merge_method: str, sha: str):
+    """Fixed version of PyGithub merge with commit_title, merge_method, and sha."""
+    post_parameters = dict()
+    post_parameters["commit_title"] = commit_title
+    post_parameters["commit_message"] = commit_message
+    post_parameters["merge_method"] = merge_method
+    post_parameters["sha"] = sha
+    headers, data = pullRequest._requester.requestJsonAndCheck(
+	"PUT",
+	pullRequest.url + "/merge",
+	input=post_parameters
+    )
+    try:
+        return github.PullRequestMergeStatus.PullRequestMergeStatus(pullRequest._requester, headers, data, completed=True)
+    except TypeError:
+        # PyGithub 2 no longer takes completed for non-completable objects.
+        return github.PullRequestMergeStatus.PullRequestMergeStatus(pullRequest._requester, headers, data)
+
+def requestReview(pullRequest: PullRequest.PullRequest, reviewers: List[str]):
+    """Request review for a pull request."""
+    post_parameters = dict()
+    post_parameters["reviewers"] = reviewers
+    headers, data = pullRequest._requester.requestJsonAndCheck(
+	"POST",
+	pullRequest.url + "/requested_reviewers",
+	input=post_parameters,
+        headers={'Accept': 'application/vnd.github.black-cat-preview+json'}
+    )
+
+def fetchPullRequest(pullRequest: PullRequest.PullRequest, etag: Optional[str]=None) -> tuple:
+    """GET a single pull request, conditional on etag, and return (pull request, etag)."""
+    headers = {'If-None-Match': etag} if etag else {}
+    status, responseHeaders, output = pullRequest._requester.requestJson(
+        "GET",
+        pullRequest.url,
+        headers=headers
+    )
+    if status == 304:
+        # Unchanged, and not counted against the rate limit.
+        return (pullRequest, etag)
+    if status != 200:
+        raise click.ClickException("Reading pull request %s failed with status %d" % (pullRequest.url, status))
+    pullRequest = PullRequest.PullRequest(pullRequest._requester, responseHeaders, json.loads(output), completed=True)
+    return (pullRequest, responseHeaders.get('etag'))
+
+def mergeabilityKnown(pullRequest: PullRequest.PullRequest) -> bool:
+    """Condition for waitForPullRequest: GitHub has finished its merge check."""
+    return pullRequest.mergeable is not None
+
+def waitForPullRequest(pullRequest: PullRequest.PullRequest, etag: Optional[str],
+        condition: Callable[[PullRequest.PullRequest], bool], description: str,
+        timeout: float) -> PullRequest.PullRequest:
+    """Poll a pull request, given in its latest known state, until condition holds.
+
+    Polls the single pull request endpoint with conditional requests, backing off exponentially
+    with jitter, and fails once timeout seconds have passed. Returns the latest state.
+    """
+    start = time.time()
+    if condition(pullRequest):
+        return pullRequest
+    click.echo('Waiting for %s' % description)
+    delay = PULL_POLL_INITIAL
+    while not condition(pullRequest):
+        remaining = start + timeout - time.time()
+        if remaining <= 0:
+            click.echo('')
+            raise click.ClickException("Timed out after %ds waiting for %s" % (timeout, description))
+        click.echo('=', nl=False)
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, PULL_POLL_MAX)
+        pullRequest, etag = fetchPullRequest(pullRequest, etag)
+    click.echo(' %.1fs' % (time.time() - start))
+    return pullRequest
+
+class GithubSession(object):
+    """GitHub client for a remote, shared by every command in the process.
+
+    Credentials are filled once, one Github client keeps its HTTP connection alive between
+    requests, and repository metadata is kept in .git/g8 so warm runs skip the lookups.
+    """
+    _sessions = {}
+
+    def __init__(self, remote: str):
+        self.remote = remote
+        self.url = urlparse(remote)
+        self._client = None
+        self._repo = None
+
+    @classmethod
+    def forRemote(cls, git: 'GitWrapper') -> 'GithubSession':
+        remote = git.callAndGetUtf8(['remote', 'get-url', 'origin'])
+        if remote not in cls._sessions:
+            cls._sessions[remote] = cls(remote)
+        return cls._sessions[remote]
+
+    def ownerAndName(self) -> List[str]:
+        """Split the remote path into the repository owner and name, without any .git suffix."""
+        path = self.url.path.strip('/')
+        if path.endswith('.git'):
+            path = path[:-len('.git')]
+        return path.split('/', 1)
+
+    def client(self, git: 'GitWrapper') -> Github:
+        """Read git credentials once and return the Github client."""
+        if self._client is None:
+            fillInput = (
+                'protocol=%s\n' % self.url.scheme +
+                'host=%s\n' % self.url.netloc +
+                'path=%s\n' % self.url.path +
+                '\n'
+            ).encode('utf-8')
+
+            fillOutput = git.callAndGetUtf8(['credential', 'fill'], stdin=fillInput)
+            creds = dict(re.findall(r'(\S+)=(\S+)', fillOutput))
+
+            self._client = Github(creds.get('username'), creds.get('password'),
+                    base_url=os.environ.get(GITHUB_API_ENV, GITHUB_API_DEFAULT))
+            if git.profiler:
+                watchRequests(git.profiler)
+        return self._client
+
+    def repo(self, git: 'GitWrapper') -> Repository.Repository:
+        """Return the Repository, from cached metadata when it is fresh."""
+        if self._repo is None:
+            client = self.client(git)
+            cache = git.readCache('github-repo.json')
+            metadata = cache.get(self.remote)
+            if metadata and time.time() - metadata['fetched'] < GITHUB_REPO_TTL:
+                git.countCache('github-repo', True)
+                # Build the object locally; attributes missing from the cache are fetched on access.
+                self._repo = Repository.Repository(
+                        client._Github__requester, {}, metadata['attributes'], completed=False)
+            else:
+                git.countCache('github-repo', False)
+                orgName, repoName = self.ownerAndName()
+                org = client.get_organization(orgName)
+                self._repo = org.get_repo(repoName)
+                cache[self.remote] = {
+                    'fetched': time.time(),
+                    'attributes': {
+                        'id': self._repo.id,
+                        'name': self._repo.name,
+                        'full_name': self._repo.full_name,
+                        'default_branch': self._repo.default_branch,
+                        'owner': {'login': self._repo.owner.login},
+                        'url': self._repo.url,
+                    },
+                }
+                git.writeCache('github-repo.json', cache)
+        return self._repo
+
+    def openPullRequest(self, git: 'GitWrapper', remoteBranch: str) -> tuple:
+        """Return (pull request, etag) for the open pull request of a remote branch, or (None, None).
+
+        Pull requests are indexed by remote branch in .git/g8/pulls.json. An indexed one costs a
+        single conditional GET, which GitHub answers with 304 when nothing changed; only branches
+        missing from the index, or whose pull request was closed, need a search.
+        """
+        requester = self.client(git)._Github__requester
+        entry = git.readCache('pulls.json').get(self.remote, {}).get(remoteBranch)
+        if entry:
+            git.countCache('pulls', True)
+            known = PullRequest.PullRequest(requester, {}, entry['data'], completed=True)
+            pullRequest, etag = fetchPullRequest(known, entry['etag'])
+            if pullRequest.state == 'open':
+                if etag != entry['etag']:
+                    self.rememberPullRequest(git, remoteBranch, pullRequest, etag)
+                return (pullRequest, etag)
+        else:
+            git.countCache('pulls', False)
+
+        pullRequests = list(self.repo(git).get_pulls(head='8thwall:%s' % remoteBranch))
+        if len(pullRequests) > 1:
+            raise click.ClickException("More than one open pull request in " + remoteBranch)
+        if not pullRequests:
+            self.forgetPullRequest(git, remoteBranch)
+            return (None, None)
+        # Listed pull requests are partial; read the full one once, for the index.
+        pullRequest, etag = fetchPullRequest(pullRequests[0])
+        self.rememberPullRequest(git, remoteBranch, pullRequest, etag)
+        return (pullRequest, etag)
+
+    def rememberPullRequest(self, git: 'GitWrapper', remoteBranch: str,
+            pullRequest: PullRequest.PullRequest, etag: Optional[str]) -> None:
+        """Index the full state of a pull request, as read with etag."""
+        cache = git.readCache('pulls.json')
+        cache.setdefault(self.remote, {})[remoteBranch] = {
+            'number': pullRequest.number,
+            'etag': etag,
+            'data': pullRequest.raw_data,
+        }
+        git.writeCache('pulls.json', cache)
+
+    def forgetPullRequest(self, git: 'GitWrapper', remoteBranch: str) -> None:
+        cache = git.readCache('pulls.json')
+        if cache.get(self.remote, {}).pop(remoteBranch, None):
+            git.writeCache('pulls.json', cache)
+
+    def pullStatus(self, git: 'GitWrapper', remoteBranches: List[str]) -> dict:
+        """Return the open pull request state of each remote branch, or None where there is none.
+
+        All branches are looked up in one GraphQL request, and the answer is kept in .git/g8
+        for PULL_STATUS_TTL seconds.
+        """
+        cache = git.readCache('pull-status.json')
+        entry = cache.get(self.remote)
+        if (entry and time.time() - entry['fetched'] < PULL_STATUS_TTL
+                and all(branch in entry['pulls'] for branch in remoteBranches)):
+            git.countCache('pull-status', True)
+            return dict([(branch, entry['pulls'][branch]) for branch in remoteBranches])
+        git.countCache('pull-status', False)
+
+        owner, name = self.ownerAndName()
+        variables = {'owner': owner, 'name': name}
+        declarations = ['$owner: String!', '$name: String!']
+        selections = []
+        for i, branch in enumerate(remoteBranches):
+            variables['b%d' % i] = branch
+            declarations.append('$b%d: String!' % i)
+            selections.append('c%d: pullRequests(headRefName: $b%d, states: OPEN, first: 1) {%s}' % (
+                i, i, PULL_STATUS_FIELDS))
+        query = 'query(%s) { repository(owner: $owner, name: $name) { %s } }' % (
+            ', '.join(declarations), '\n'.join(selections))
+
+        _, data = self.client(git)._Github__requester.graphql_query(query, variables)
+        repository = data['data']['repository']
+
+        pulls = {}
+        for i, branch in enumerate(remoteBranches):
+            nodes = repository['c%d' % i]['nodes']
+            if not nodes:
+                pulls[branch] = None
+                continue
+            commits = nodes[0]['commits']['nodes']
+            rollup = commits[0]['commit']['statusCheckRollup'] if commits else None
+            pulls[branch] = {
+                'number': nodes[0]['number'],
+                'url': nodes[0]['url'],
+                'review': nodes[0]['reviewDecision'],
+                'mergeable': nodes[0]['mergeable'],
+                'checks': rollup and rollup['state'],
+            }
+        cache[self.remote] = {'fetched': time.time(), 'pulls': pulls}
+        git.writeCache('pull-status.json', cache)
+
+        # Drop indexed pull requests that have since been closed or replaced.
+        index = git.readCache('pulls.json')
+        indexed = index.get(self.remote, {})
+        stale = [branch for branch in remoteBranches
+                if branch in indexed and indexed[branch]['number'] != (pulls[branch] or {}).get('number')]
+        if stale:
+            for branch in stale:
+                del indexed[branch]
+            git.writeCache('pulls.json', index)
+        return pulls
+
+def getGithubRepo(git: 'GitWrapper') -> Repository.Repository:
+    """Read git credentials and return github Repo object."""
+    return GithubSession.forRemote(git).repo(git)